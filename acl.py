@@ -0,0 +1,201 @@
+import sys
+import threading
+
+from metadata_store import get_store
+from render_cache import bump_generation
+from user_directory import get_directory
+
+
+def compile_links(users):
+    """Symmetric issuer <-> custodian links from a UserSnapshot.
+
+    A name in either side's 'manages' list links the pair, so the two lists
+    cannot disagree about who may see what.
+    """
+    links = {}
+    for name, manages in users.manages.items():
+        for other in manages:
+            links.setdefault(name, set()).add(other)
+            links.setdefault(other, set()).add(name)
+    return links
+
+
+class AccessIndex:
+    """Compiled answer to "may this user read this file?".
+
+    Issuers read their own files. A custodian reads a file when the file
+    names them and they are linked to its issuer. Everything is kept as
+    dicts of sets so each check is a couple of hash lookups:
+
+      _issuer_of[file_id]          -> issuer
+      _shared[custodian][issuer]   -> ids of the issuer's files naming them
+      _links[user]                 -> users linked to them
+
+    The file tables follow the metadata store's generation: changes from
+    other processes are patched in from the store's change log (or rebuilt
+    when it keeps none) and uploads made by this process are added directly.
+    The links are rebuilt from each new users.json snapshot (they are
+    cheap) and patched by link() in the meantime.
+    """
+
+    def __init__(self, store, directory):
+        self._store = store
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._users_generation = None
+        self._store_generation = None
+        self._cursor = None
+        self._links = {}
+        self._issuer_of = {}
+        self._custodians_of = {}
+        self._owned = {}
+        self._shared = {}
+
+    def _index_file(self, issuer_of, custodians_of, owned, shared, file_id, issuer, custodians):
+        issuer_of[file_id] = issuer
+        owned.setdefault(issuer, set()).add(file_id)
+        if custodians:
+            custodians_of[file_id] = tuple(custodians)
+        for custodian in custodians:
+            shared.setdefault(custodian, {}).setdefault(issuer, set()).add(file_id)
+
+    def _unindex_file(self, file_id):
+        if file_id not in self._issuer_of:
+            return
+        issuer = self._issuer_of.pop(file_id)
+        self._owned.get(issuer, set()).discard(file_id)
+        for custodian in self._custodians_of.pop(file_id, ()):
+            self._shared.get(custodian, {}).get(issuer, set()).discard(file_id)
+
+    def _refresh(self):
+        users = self._directory.snapshot()
+        generation = self._store.generation()
+        if users.generation == self._users_generation and generation == self._store_generation:
+            return
+        with self._lock:
+            if users.generation != self._users_generation:
+                self._links = compile_links(users)
+                self._users_generation = users.generation
+            if generation != self._store_generation:
+                changes = None if self._cursor is None else self._store.changes_since(self._cursor)
+                if changes is None or len(changes[1]) > len(self._issuer_of) // 4:
+                    self._rebuild()
+                else:
+                    self._cursor, ids = changes
+                    for file_id in ids:
+                        self._unindex_file(file_id)
+                    self._add_records(self._store.files_by_ids(sorted(ids)))
+                self._store_generation = generation
+
+    def _rebuild(self):
+        self._cursor = self._store.change_cursor()
+        issuer_of, custodians_of, owned, shared = {}, {}, {}, {}
+        for entry in self._store.access_entries():
+            self._index_file(issuer_of, custodians_of, owned, shared, *entry)
+        self._issuer_of, self._custodians_of = issuer_of, custodians_of
+        self._owned, self._shared = owned, shared
+
+    def _add_records(self, records):
+        for record in records:
+            self._index_file(
+                self._issuer_of, self._custodians_of, self._owned, self._shared,
+                record["id"], record.get("issuer"), record.get("custodians", ()),
+            )
+
+    def linked(self, user, other):
+        self._refresh()
+        return other in self._links.get(user, ())
+
+    def partners(self, user):
+        """Users linked to ``user``: a custodian's issuers or an issuer's custodians."""
+        self._refresh()
+        return frozenset(self._links.get(user, ()))
+
+    def can_read(self, user, file_id):
+        self._refresh()
+        issuer = self._issuer_of.get(file_id)
+        if issuer is None or not user:
+            return False
+        if issuer == user:
+            return True
+        return issuer in self._links.get(user, ()) and file_id in self._shared.get(user, {}).get(issuer, ())
+
+    def readable_ids(self, user):
+        """Every file id ``user`` may read."""
+        self._refresh()
+        with self._lock:
+            ids = set(self._owned.get(user, ()))
+            shared = self._shared.get(user, {})
+            for issuer in self._links.get(user, ()):
+                ids.update(shared.get(issuer, ()))
+        return ids
+
+    def file_added(self, record):
+        """Index a record this process just stored, without a rebuild."""
+        self.files_added([record])
+
+    def files_added(self, records):
+        """Index records this process just stored in one write."""
+        with self._lock:
+            self._add_records(records)
+            if self._store.exact_generation and self._store_generation is not None:
+                # Only adopt the new generation if ours was the sole write.
+                if self._store.generation() == self._store_generation + len(records):
+                    self._store_generation += len(records)
+
+    def link(self, issuer, custodian):
+        """Record a new issuer/custodian link until the next users.json reload."""
+        with self._lock:
+            self._links.setdefault(issuer, set()).add(custodian)
+            self._links.setdefault(custodian, set()).add(issuer)
+
+
+def link_users(users, issuer, custodian):
+    """Add each user to the other's 'manages' list in raw users.json data.
+
+    Returns True if either list changed. Meant to be called from a
+    UserDirectory.update() mutate function.
+    """
+    changed = False
+    for name, other in ((issuer, custodian), (custodian, issuer)):
+        manages = users[name].setdefault("manages", [])
+        if other not in manages:
+            manages.append(other)
+            changed = True
+    return changed
+
+
+def repair_links(users):
+    """Make every one-sided 'manages' entry in users.json mutual; returns the number fixed."""
+    fixed = 0
+    for name in list(users):
+        for other in list(users[name].get("manages", [])):
+            if other in users and name not in users[other].get("manages", []):
+                users[other].setdefault("manages", []).append(name)
+                fixed += 1
+    return fixed or False
+
+
+_acl = None
+_acl_lock = threading.Lock()
+
+
+def get_acl():
+    """Return the process-wide AccessIndex."""
+    global _acl
+    if _acl is None:
+        with _acl_lock:
+            if _acl is None:
+                _acl = AccessIndex(get_store(), get_directory())
+    return _acl
+
+
+if __name__ == "__main__":
+    # python acl.py repair  -- make issuer/custodian 'manages' lists mutual
+    if sys.argv[1:] != ["repair"]:
+        sys.exit("usage: python acl.py repair")
+    fixed = get_directory().update(repair_links)
+    if fixed:
+        # Dashboards list each user's partners
+        bump_generation()
+    print(f"Fixed {fixed or 0} one-sided links")
@@ -1,27 +1,79 @@
+import gc
+import os
+
 from flask import Flask, redirect, url_for
-from routes.auth import auth_blueprint  
-from routes.dashboard import dashboard_bp
-from routes.file_upload import file_upload
-from routes.custodian import custodian_bp
 
-import os
+import config
+
+
+def create_app(overrides=None, preload=False):
+    """Build the Flask app.
+
+    ``overrides`` maps config.py setting names to values (e.g. DATA_DIR) and
+    is applied before anything opens a store. With ``preload`` the caches
+    are built here, for servers that import the app once and then fork.
+    """
+    if overrides:
+        config.configure(overrides)
+
+    # Blueprints import the stores, so they are loaded after configure().
+    import metrics
+    from routes.auth import auth_blueprint
+    from routes.chunked_upload import chunked_upload
+    from routes.custodian import custodian_bp
+    from routes.dashboard import dashboard_bp
+    from routes.file_upload import file_upload
+    from routes.jobs import jobs_bp
+    from routes.search import search_bp
+
+    for folder in (config.STORAGE_FOLDER, config.UPLOAD_FOLDER, config.PARTIAL_UPLOAD_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+
+    app = Flask(__name__)
+    app.secret_key = os.getenv("FLASK_SECRET_KEY", "your_secret_key")
+    app.config["MAX_CONTENT_LENGTH"] = config.MAX_UPLOAD_SIZE
+    app.config["USE_X_SENDFILE"] = config.DOWNLOAD_OFFLOAD == "x-sendfile"
+
+    # Register Blueprints
+    app.register_blueprint(auth_blueprint, url_prefix="/auth")
+    app.register_blueprint(dashboard_bp, url_prefix="/dashboard")
+    app.register_blueprint(file_upload)
+    app.register_blueprint(custodian_bp, url_prefix='/custodian')
+    app.register_blueprint(chunked_upload)
+    app.register_blueprint(jobs_bp)
+    app.register_blueprint(search_bp)
+    metrics.init_app(app)
+
+    @app.route("/")
+    def index():
+        return redirect(url_for("auth.login"))  # 'auth' is the name of the Blueprint, not the variable
+
+    if preload:
+        warm_caches()
+    return app
 
-app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "your_secret_key")
 
-# Register Blueprints
-app.register_blueprint(auth_blueprint, url_prefix="/auth")  # ✅ using auth_blueprint here
-app.register_blueprint(dashboard_bp, url_prefix="/dashboard")
-app.register_blueprint(file_upload)
-app.register_blueprint(custodian_bp, url_prefix='/custodian')
+def warm_caches():
+    """Load everything a worker would otherwise build on its first requests.
 
-for rule in app.url_map.iter_rules():
-    print(f"{rule.endpoint} --> {rule.rule}")
+    Run in a server's master process before it forks: the parsed users,
+    file records, access and search indexes and the parsing libraries are
+    then shared copy-on-write by every worker instead of rebuilt per worker.
+    """
+    import columnar  # noqa: F401  (numpy)
+    import openpyxl  # noqa: F401
+    from acl import get_acl
+    from search_index import get_search_index
+    from user_directory import get_directory
 
+    get_directory().snapshot()
+    get_acl().partners("")  # compiles links and file tables from the store
+    get_search_index().search(get_acl(), "", limit=1)  # builds the search index
+    # Move everything loaded so far out of the collector's reach, so the
+    # first collection in a worker does not touch (and copy) these pages.
+    gc.collect()
+    gc.freeze()
 
-@app.route("/")
-def index():
-    return redirect(url_for("auth.login"))  # 'auth' is the name of the Blueprint, not the variable
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,389 @@
+"""Benchmark the login, dashboard, upload and download paths.
+
+    python bench/run.py [--entries 1k,100k,1m] [--mode client,http] ...
+    python bench/run.py compare OLD.json NEW.json [--threshold 10]
+
+Each catalog size runs in its own process against a throwaway workspace
+(a temp dir passed to create_app() as DATA_DIR), so nothing touches the
+real data. "client"
+drives the blueprints through Flask's test client in-process; "http" starts
+a threaded werkzeug server and hammers it from --concurrency processes.
+Results go to bench/results/<commit>.json unless --out is given.
+"""
+import argparse
+import http.client
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [REPO_ROOT, BENCH_DIR]
+
+import synth  # noqa: E402
+
+SCENARIOS = ("login", "dashboard", "custodian_dashboard", "upload", "download")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, wall_seconds, transferred=0):
+    latencies = sorted(latencies)
+    summary = {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 2),
+    }
+    if transferred:
+        summary["throughput_mib_s"] = round(transferred / wall_seconds / 2 ** 20, 2)
+    return summary
+
+
+def upload_payload(args):
+    if args.upload_format == "xlsx":
+        return synth.xlsx_bytes(args.upload_rows), "xlsx"
+    return synth.csv_bytes(args.upload_rows), "csv"
+
+
+# -- in-process test client -------------------------------------------------
+
+def _client_requests(app, info, payload, extension):
+    """Map scenario -> (setup or None, request(i) returning bytes transferred)."""
+    issuer = app.test_client()
+    custodian = app.test_client()
+    anonymous = app.test_client()
+    credentials = {"username": info["issuer"], "password": synth.BENCH_PASSWORD}
+
+    def login(client, username):
+        response = client.post("/auth/login", data={"username": username, "password": synth.BENCH_PASSWORD})
+        assert response.status_code == 302, response.status_code
+
+    def fetch(response, status):
+        assert response.status_code == status, (response.request.path, response.status_code)
+        size = len(response.get_data())
+        response.close()
+        return size
+
+    def do_login(i):
+        fetch(anonymous.post("/auth/login", data=credentials), 302)
+        return 0
+
+    def dashboard(i):
+        fetch(issuer.get("/dashboard/"), 200)
+        return 0
+
+    def custodian_dashboard(i):
+        fetch(custodian.get("/custodian/dashboard"), 200)
+        return 0
+
+    def upload(i):
+        data = {
+            "file": (io.BytesIO(payload), f"bench-upload-{uuid.uuid4().hex[:12]}.{extension}"),
+            "custodians": info["custodian"],
+        }
+        fetch(issuer.post("/dashboard/", data=data, content_type="multipart/form-data"), 302)
+        return len(payload)
+
+    def download(i):
+        return fetch(issuer.get(f"/download/{info['download']}?issuer={info['issuer']}"), 200)
+
+    as_issuer = lambda: login(issuer, info["issuer"])  # noqa: E731
+    return {
+        "login": (None, do_login),
+        "dashboard": (as_issuer, dashboard),
+        "custodian_dashboard": (lambda: login(custodian, info["custodian"]), custodian_dashboard),
+        "upload": (as_issuer, upload),
+        "download": (as_issuer, download),
+    }
+
+
+def run_client(app, info, args):
+    payload, extension = upload_payload(args)
+    results = {}
+    for name, (setup, request) in _client_requests(app, info, payload, extension).items():
+        if name not in args.scenarios:
+            continue
+        if setup:
+            setup()
+        for i in range(args.warmup):
+            request(i)
+        latencies, transferred = [], 0
+        started = time.perf_counter()
+        for i in range(args.requests):
+            t = time.perf_counter()
+            transferred += request(i)
+            latencies.append(time.perf_counter() - t)
+        results[name] = summarize(latencies, time.perf_counter() - started, transferred)
+    return results
+
+
+# -- HTTP load generator ----------------------------------------------------
+
+def _multipart(fields, file_field, filename, content):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode() + content + b"\r\n"
+    )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _http_worker(port, scenario, info, count, warmup, payload, extension):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+
+    def send(method, path, body=None, headers=None):
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        return response, data
+
+    def login(username):
+        form = urlencode({"username": username, "password": synth.BENCH_PASSWORD})
+        response, _ = send("POST", "/auth/login", form, {"Content-Type": "application/x-www-form-urlencoded"})
+        assert response.status == 302, response.status
+        return {"Cookie": response.getheader("Set-Cookie").split(";", 1)[0]}
+
+    if scenario == "login":
+        form = urlencode({"username": info["issuer"], "password": synth.BENCH_PASSWORD})
+        request = lambda: (send("POST", "/auth/login", form, {"Content-Type": "application/x-www-form-urlencoded"}), 302, 0)
+    elif scenario == "custodian_dashboard":
+        cookie = login(info["custodian"])
+        request = lambda: (send("GET", "/custodian/dashboard", headers=cookie), 200, 0)
+    else:
+        cookie = login(info["issuer"])
+        if scenario == "dashboard":
+            request = lambda: (send("GET", "/dashboard/", headers=cookie), 200, 0)
+        elif scenario == "download":
+            path = f"/download/{info['download']}?issuer={info['issuer']}"
+            request = lambda: (send("GET", path, headers=cookie), 200, None)
+        else:
+            def request():
+                body, content_type = _multipart(
+                    {"custodians": info["custodian"]}, "file",
+                    f"bench-upload-{uuid.uuid4().hex[:12]}.{extension}", payload,
+                )
+                return send("POST", "/dashboard/", body, dict(cookie, **{"Content-Type": content_type})), 302, len(payload)
+
+    latencies, transferred = [], 0
+    for i in range(warmup + count):
+        t = time.perf_counter()
+        (response, data), status, size = request()
+        elapsed = time.perf_counter() - t
+        assert response.status == status, (scenario, response.status)
+        if i >= warmup:
+            latencies.append(elapsed)
+            transferred += len(data) if size is None else size
+    conn.close()
+    return latencies, transferred
+
+
+def run_http(app, info, args):
+    """Serve the app from this process and load it from ``concurrency`` clients.
+
+    The server runs on a thread here, so it shares this process's stores
+    and job queue; the clients are separate processes so their own Python
+    overhead does not compete with the server for the GIL.
+    """
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no per-request access log
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        payload, extension = upload_payload(args)
+        per_worker = max(1, args.requests // args.concurrency)
+        results = {}
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(args.concurrency) as pool:
+            for scenario in SCENARIOS:
+                if scenario not in args.scenarios:
+                    continue
+                started = time.perf_counter()
+                parts = pool.starmap(_http_worker, [
+                    (server.server_port, scenario, info, per_worker, args.warmup, payload, extension)
+                ] * args.concurrency)
+                wall = time.perf_counter() - started
+                latencies = [value for part, _ in parts for value in part]
+                results[scenario] = summarize(latencies, wall, sum(size for _, size in parts))
+        return results
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+# -- driver -----------------------------------------------------------------
+
+def run_catalog(entries, args, results):
+    """Build one synthetic workspace and benchmark it, in a fresh process.
+
+    The run is put on the ``results`` queue.
+    """
+    workdir = tempfile.mkdtemp(prefix=f"sdira-bench-{entries}-", dir=args.workdir)
+    overrides = {"DATA_DIR": workdir, "METADATA_BACKEND": args.backend}
+    if args.job_workers is not None:
+        overrides["JOB_WORKERS"] = args.job_workers
+    try:
+        import config
+        from app import create_app
+        from metadata_store import get_store
+
+        app = create_app(overrides)
+        from werkzeug.security import generate_password_hash
+
+        started = time.perf_counter()
+        password_hash = generate_password_hash(synth.BENCH_PASSWORD, config.PASSWORD_HASH_METHOD)
+        info = synth.write_catalog(
+            entries, get_store(), config.USER_FILE, password_hash, blob_rows=args.upload_rows
+        )
+        run = {
+            "entries": entries,
+            "backend": args.backend,
+            "setup_seconds": round(time.perf_counter() - started, 2),
+            "catalog": info,
+        }
+        if "client" in args.mode:
+            run["client"] = run_client(app, info, args)
+        if "http" in args.mode:
+            run["http"] = run_http(app, info, args)
+    except BaseException:
+        # Let the parent report the failure instead of waiting forever.
+        results.put({"entries": entries, "error": traceback.format_exc()})
+        raise
+    finally:
+        # Let queued parse jobs finish against the workdir before it goes.
+        import jobs
+
+        if jobs._queue is not None and jobs._queue._pool is not None:
+            jobs._queue._pool.shutdown(wait=True)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results.put(run)
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path, new_path, threshold):
+    """Print p50/p99 changes between two result files; exit 1 on regressions."""
+    with open(old_path) as f:
+        old = {(r["entries"], r["backend"]): r for r in json.load(f)["runs"]}
+    with open(new_path) as f:
+        new = json.load(f)["runs"]
+    regressions = 0
+    for run in new:
+        base = old.get((run["entries"], run["backend"]))
+        if base is None:
+            continue
+        for mode in ("client", "http"):
+            for scenario, stats in run.get(mode, {}).items():
+                before = base.get(mode, {}).get(scenario)
+                if not before:
+                    continue
+                for key in ("p50_ms", "p99_ms"):
+                    change = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+                    flag = ""
+                    if change > threshold:
+                        flag = "  REGRESSION"
+                        regressions += 1
+                    print(f"{run['entries']:>8} {run['backend']:<7} {mode:<6} {scenario:<20} {key:<6}"
+                          f" {before[key]:>10.2f} -> {stats[key]:>10.2f} ({change:+6.1f}%){flag}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["compare"]:
+        parser = argparse.ArgumentParser(prog="bench/run.py compare")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        parser.add_argument("--threshold", type=float, default=10.0, help="percent slowdown to flag")
+        args = parser.parse_args(argv[1:])
+        return compare(args.old, args.new, args.threshold)
+
+    parser = argparse.ArgumentParser(prog="bench/run.py", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", default="1k", help="comma-separated catalog sizes, e.g. 1k,100k,1m")
+    parser.add_argument("--backend", default="sqlite", choices=("sqlite", "json", "msgpack"))
+    parser.add_argument("--mode", default="client,http", help="client, http or both")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4, help="HTTP client processes")
+    parser.add_argument("--upload-rows", type=int, default=1000, help="rows in synthetic uploads")
+    parser.add_argument("--upload-format", default="csv", choices=("csv", "xlsx"))
+    parser.add_argument("--job-workers", type=int, default=None, help="override JOB_WORKERS")
+    parser.add_argument("--workdir", default=None, help="parent dir for temporary workspaces")
+    parser.add_argument("--keep", action="store_true", help="keep the workspaces")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args(argv)
+    args.mode = args.mode.split(",")
+    args.scenarios = args.scenarios.split(",")
+
+    commit = _commit()
+    report = {
+        "commit": commit,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k != "out"},
+        "runs": [],
+    }
+    ctx = multiprocessing.get_context("spawn")
+    for entries in (synth.parse_count(e) for e in args.entries.split(",")):
+        # Not a Pool: its workers are daemonic and may not start the server
+        # and load-generator processes.
+        results = ctx.Queue()
+        child = ctx.Process(target=run_catalog, args=(entries, args, results))
+        child.start()
+        run = results.get()
+        child.join()
+        if "error" in run:
+            sys.stderr.write(run["error"])
+            return 1
+        report["runs"].append(run)
+        for mode in ("client", "http"):
+            for scenario, stats in run.get(mode, {}).items():
+                print(f"{entries:>8} {mode:<6} {scenario:<20} p50 {stats['p50_ms']:>9.2f} ms"
+                      f"  p99 {stats['p99_ms']:>9.2f} ms  {stats['throughput_rps']:>8.1f} req/s")
+
+    out = args.out or os.path.join(BENCH_DIR, "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Synthetic users, file catalogs and spreadsheets for the benchmarks."""
+import csv
+import io
+import json
+import random
+from datetime import datetime, timedelta
+
+BENCH_PASSWORD = "bench-password"
+LINKS_PER_ISSUER = 3
+
+
+def parse_count(text):
+    """'1k' -> 1000, '100k' -> 100000, '1m' -> 1000000."""
+    text = text.strip().lower()
+    scale = {"k": 1000, "m": 1000 * 1000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+
+def csv_bytes(rows, columns=8, seed=0):
+    """A CSV with a header, numeric and text columns, ``rows`` data rows."""
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow([f"col{c}" for c in range(columns)])
+    for r in range(rows):
+        writer.writerow([
+            rng.randint(0, 10 ** 6) if c % 2 == 0 else f"text-{rng.randint(0, 5000)}-{r}"
+            for c in range(columns)
+        ])
+    return out.getvalue().encode("utf-8")
+
+
+def xlsx_bytes(rows, columns=8, seed=0):
+    """The same shape as csv_bytes() as an XLSX workbook."""
+    from openpyxl import Workbook
+
+    rng = random.Random(seed)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    sheet.append([f"col{c}" for c in range(columns)])
+    for r in range(rows):
+        sheet.append([
+            rng.randint(0, 10 ** 6) if c % 2 == 0 else f"text-{rng.randint(0, 5000)}-{r}"
+            for c in range(columns)
+        ])
+    out = io.BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+def build_users(entries, password_hash):
+    """users.json data with about one user per ten catalog entries.
+
+    Every user shares one precomputed hash: hashing a million passwords
+    would dominate setup and measures nothing about the app.
+    """
+    count = max(20, entries // 10)
+    issuers = [f"bench-issuer-{i}" for i in range(count // 2)]
+    custodians = [f"bench-custodian-{i}" for i in range(count - len(issuers))]
+    users = {name: {"password": password_hash, "role": "issuer", "manages": []} for name in issuers}
+    users.update({name: {"password": password_hash, "role": "custodian", "manages": []} for name in custodians})
+    for i, issuer in enumerate(issuers):
+        for k in range(LINKS_PER_ISSUER):
+            custodian = custodians[(i + k) % len(custodians)]
+            users[issuer]["manages"].append(custodian)
+            users[custodian]["manages"].append(issuer)
+    return users, issuers, custodians
+
+
+def iter_file_records(entries, users, issuers, blobs, seed=0):
+    """``entries`` file records spread over the issuers, sharing a few blobs.
+
+    ``blobs`` is a list of (sha256, size) pairs the records point at, so
+    downloads serve real content without writing one file per record.
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    for i in range(entries):
+        issuer = issuers[i % len(issuers)]
+        linked = users[issuer]["manages"]
+        sha256, size = blobs[i % len(blobs)]
+        yield {
+            "filename": f"report-{i:07d}.csv",
+            "size": size,
+            "upload_time": (start + timedelta(seconds=i * 31)).isoformat(),
+            "mime_type": "text/csv",
+            "issuer": issuer,
+            "custodians": rng.sample(linked, k=min(len(linked), 2)),
+            "sha256": sha256,
+        }
+
+
+def write_catalog(entries, store, users_path, password_hash, blob_rows=1000, blob_count=8, batch=50000):
+    """Populate users.json, the blob store and ``store`` for a benchmark run.
+
+    Returns a dict describing the catalog (counts, the busiest issuer and
+    custodian, and a downloadable filename).
+    """
+    import blobstore
+
+    users, issuers, custodians = build_users(entries, password_hash)
+    with open(users_path, "w") as f:
+        json.dump(users, f)
+
+    blobs = [blobstore.put_stream(io.BytesIO(csv_bytes(blob_rows, seed=s))) for s in range(blob_count)]
+    chunk = []
+    for record in iter_file_records(entries, users, issuers, blobs):
+        chunk.append(record)
+        if len(chunk) >= batch:
+            store.import_records(chunk)
+            chunk = []
+    if chunk:
+        store.import_records(chunk)
+
+    return {
+        "entries": entries,
+        "users": len(users),
+        "issuer": issuers[0],
+        "custodian": users[issuers[0]]["manages"][0],
+        "download": "report-0000000.csv",
+        "blob_bytes": blobs[0][1],
+    }
@@ -0,0 +1,291 @@
+import gzip
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import config
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# Cold blobs are gzipped in place: <sha256>.gz replaces <sha256>. The hash
+# is still that of the original bytes.
+COMPRESSED_SUFFIX = ".gz"
+# Content that is already compressed (xlsx is a ZIP) is left alone.
+COMPRESSED_MAGIC = (b"PK\x03\x04", b"\x1f\x8b")
+
+
+def blob_path(sha256):
+    """Location of a blob: two levels of two-hex-digit shards, then the full hash."""
+    return os.path.join(config.BLOB_FOLDER, sha256[:2], sha256[2:4], sha256)
+
+
+def compressed_path(sha256):
+    return blob_path(sha256) + COMPRESSED_SUFFIX
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIX)
+
+
+def stored_path(sha256):
+    """Path of a blob as it is kept on disk, raw or compressed; None if missing."""
+    for path in (blob_path(sha256), compressed_path(sha256)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def has_blob(sha256):
+    return stored_path(sha256) is not None
+
+
+def open_blob(sha256):
+    """Open a blob for reading its original bytes, decompressing cold blobs on the fly."""
+    try:
+        return open(blob_path(sha256), "rb")
+    except FileNotFoundError:
+        return gzip.open(compressed_path(sha256), "rb")
+
+
+def file_path(record):
+    """On-disk path of a file record's content.
+
+    Records written before blob storage have no sha256 and live directly in
+    UPLOAD_FOLDER under their filename. Cold blobs resolve to their .gz file
+    (see is_compressed()).
+    """
+    if record.get("sha256"):
+        return stored_path(record["sha256"]) or blob_path(record["sha256"])
+    return os.path.join(config.UPLOAD_FOLDER, record["filename"])
+
+
+def open_path(path):
+    """Open a path returned by file_path() for reading the original bytes."""
+    return gzip.open(path, "rb") if is_compressed(path) else open(path, "rb")
+
+
+def adopt(path, sha256):
+    """Move an already-hashed file into the store, or drop it if the blob exists.
+
+    ``path`` must be on the same filesystem as BLOB_FOLDER. Returns True if
+    the blob was newly created.
+    """
+    target = blob_path(sha256)
+    existing = stored_path(sha256)
+    if existing is not None:
+        try:
+            # Restart collect_garbage()'s grace period: the caller is about
+            # to commit a record pointing at this blob.
+            os.utime(existing)
+        except FileNotFoundError:
+            existing = None  # collected meanwhile; keep the new copy
+    if existing is not None:
+        os.unlink(path)
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)
+    return True
+
+
+def put_stream(stream, max_size=None):
+    """Spool a readable stream into the store, hashing as it goes.
+
+    Returns (sha256, size). Identical content is only kept once: when the
+    blob already exists the spooled copy is discarded. Raises ValueError
+    once more than ``max_size`` bytes have been read.
+    """
+    tmp_dir = os.path.join(config.BLOB_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    hasher = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while True:
+                block = stream.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if max_size is not None and size > max_size:
+                    raise ValueError("upload exceeds the maximum size")
+                hasher.update(block)
+                tmp.write(block)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        sha256 = hasher.hexdigest()
+        adopt(tmp_path, sha256)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return sha256, size
+
+
+def iter_blobs():
+    """Yield (sha256, path) for every blob on disk, compressed ones included."""
+    for root, dirs, files in os.walk(config.BLOB_FOLDER):
+        dirs[:] = [d for d in dirs if d != "tmp"]
+        for name in files:
+            if len(name) == 64 or (len(name) == 64 + len(COMPRESSED_SUFFIX) and is_compressed(name)):
+                yield name[:64], os.path.join(root, name)
+
+
+def _compress(sha256, path, level):
+    """Gzip one blob next to itself; returns bytes saved, 0 if it was kept raw."""
+    tmp_dir = os.path.join(config.BLOB_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    st = os.stat(path)
+    hasher = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            with open(path, "rb") as src, gzip.GzipFile(fileobj=tmp, mode="wb", compresslevel=level, mtime=0) as dst:
+                for block in iter(lambda: src.read(READ_BLOCK_SIZE), b""):
+                    hasher.update(block)
+                    dst.write(block)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+            compressed = tmp.tell()
+        if hasher.hexdigest() != sha256:
+            raise ValueError(f"blob {sha256} does not match its hash")
+        if compressed > st.st_size * config.COLD_STORAGE_MAX_RATIO:
+            os.unlink(tmp_path)
+            return 0
+        # Keep the original mtime so garbage collection's grace period and
+        # later sweeps still see the blob's age.
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp_path, compressed_path(sha256))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    # Readers holding the raw file open keep reading it; new ones find the .gz.
+    os.unlink(path)
+    return st.st_size - compressed
+
+
+def compress_cold_blobs(min_age_seconds, level=None):
+    """Gzip every raw blob not modified for ``min_age_seconds``.
+
+    Returns (blobs compressed, bytes saved). Blobs in an already compressed
+    format, or that gzip cannot shrink enough, stay as they are.
+    """
+    level = config.COLD_STORAGE_LEVEL if level is None else level
+    cutoff = time.time() - min_age_seconds
+    count = saved = 0
+    for sha256, path in iter_blobs():
+        if is_compressed(path):
+            continue
+        try:
+            if os.stat(path).st_mtime >= cutoff:
+                continue
+            with open(path, "rb") as f:
+                if f.read(4).startswith(COMPRESSED_MAGIC):
+                    continue
+            gained = _compress(sha256, path, level)
+        except FileNotFoundError:
+            continue  # collected or compressed by a concurrent run
+        except ValueError as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+        count += gained > 0
+        saved += gained
+    return count, saved
+
+
+def collect_garbage(store, grace_seconds=3600):
+    """Delete blobs no file record references.
+
+    Blobs younger than ``grace_seconds`` are kept: they may belong to an
+    upload whose metadata has not been committed yet. Blobs holding old
+    versions of re-uploaded files (versions.py) count as referenced.
+    Returns the number of bytes reclaimed.
+    """
+    from versions import get_versions
+
+    referenced = {sha for sha, count in store.blob_refcounts().items() if count > 0}
+    referenced |= get_versions().referenced_blobs()
+    cutoff = time.time() - grace_seconds
+    reclaimed = 0
+    for sha256, path in iter_blobs():
+        if sha256 in referenced:
+            continue
+        st = os.stat(path)
+        if st.st_mtime < cutoff:
+            os.unlink(path)
+            reclaimed += st.st_size
+    return reclaimed
+
+
+def collect_partial_uploads(max_age_seconds):
+    """Delete chunked uploads (routes/chunked_upload.py) idle for ``max_age_seconds``.
+
+    Each upload is <id>.part, <id>.json and its lock file; it is idle when
+    none of them has changed since the cutoff. Returns the bytes reclaimed.
+    """
+    cutoff = time.time() - max_age_seconds
+    uploads = {}
+    try:
+        names = os.listdir(config.PARTIAL_UPLOAD_FOLDER)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(config.PARTIAL_UPLOAD_FOLDER, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        upload = uploads.setdefault(name.split(".", 1)[0], {"paths": [], "mtime": 0, "size": 0})
+        upload["paths"].append(path)
+        upload["mtime"] = max(upload["mtime"], st.st_mtime)
+        upload["size"] += st.st_size
+    reclaimed = 0
+    for upload in uploads.values():
+        if upload["mtime"] >= cutoff:
+            continue
+        for path in upload["paths"]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        reclaimed += upload["size"]
+    return reclaimed
+
+
+def adopt_legacy_files(store):
+    """Move flat UPLOAD_FOLDER files that records still point at into the store."""
+    moved = {}
+    for record in store.all_files():
+        if record.get("sha256"):
+            continue
+        legacy = os.path.join(config.UPLOAD_FOLDER, record["filename"])
+        if record["filename"] not in moved:
+            if not os.path.isfile(legacy):
+                continue
+            with open(legacy, "rb") as f:
+                moved[record["filename"]] = put_stream(f)[0]
+        store.set_blob(record["id"], moved[record["filename"]])
+    for filename in moved:
+        os.unlink(os.path.join(config.UPLOAD_FOLDER, filename))
+    return len(moved)
+
+
+if __name__ == "__main__":
+    # python blobstore.py adopt  -- move legacy flat uploads into the blob store
+    # python blobstore.py gc     -- reclaim unreferenced blobs and abandoned chunked uploads
+    # python blobstore.py compress  -- gzip blobs older than COLD_STORAGE_DAYS
+    from metadata_store import get_store
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "adopt":
+        print(f"Moved {adopt_legacy_files(get_store())} legacy files into {config.BLOB_FOLDER}")
+    elif command == "gc":
+        print(f"Reclaimed {collect_garbage(get_store())} bytes of blobs")
+        print(f"Reclaimed {collect_partial_uploads(config.PARTIAL_UPLOAD_TTL)} bytes of unfinished uploads")
+    elif command == "compress":
+        count, saved = compress_cold_blobs(config.COLD_STORAGE_DAYS * 86400)
+        print(f"Compressed {count} blobs, saving {saved} bytes")
+    else:
+        sys.exit("usage: python blobstore.py adopt|gc|compress")
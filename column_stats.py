@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import tempfile
+from functools import lru_cache
+
+import config
+
+# Column profiles live next to the blob's columnar cache:
+#
+#   <COLUMNAR_CACHE_FOLDER>/<sha256>/stats.json
+#
+# Reading them needs no numpy, so dashboards can show them cheaply; only
+# build_stats() (run by the upload job) imports columnar.
+STATS_FILE = "stats.json"
+
+
+def _stats_path(sha256):
+    return os.path.join(config.COLUMNAR_CACHE_FOLDER, sha256, STATS_FILE)
+
+
+def build_stats(sha256):
+    """Compute and cache the column profile of a blob; None if it has no columnar cache."""
+    existing = load_stats(sha256)
+    if existing is not None:
+        return existing
+    import columnar
+
+    stats = columnar.column_stats(sha256)
+    if stats is None:
+        return None
+    path = _stats_path(sha256)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".stats-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(stats, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return stats
+
+
+@lru_cache(maxsize=1024)
+def _cached_stats(sha256, mtime_ns):
+    with open(_stats_path(sha256)) as f:
+        return json.load(f)
+
+
+def load_stats(sha256):
+    """The cached column profile, or None when it has not been built yet."""
+    # Keyed on the file's mtime so a rebuilt profile replaces the cached one.
+    try:
+        return _cached_stats(sha256, os.stat(_stats_path(sha256)).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    # python column_stats.py  -- profile spreadsheets uploaded before column stats
+    #                            existed, rebuilding preview caches in an old format
+    import columnar
+    from metadata_store import get_store
+    from spreadsheets import file_kind
+
+    built = 0
+    for record in get_store().all_files():
+        sha256, kind = record.get("sha256"), file_kind(record["filename"])
+        if not sha256 or kind not in ("csv", "xlsx"):
+            continue
+        if columnar.load_meta(sha256) is not None and load_stats(sha256) is not None:
+            continue
+        try:
+            columnar.build_cache(sha256, kind)
+        except Exception as e:
+            print(f"Skipping {record['filename']}: {e}", file=sys.stderr)
+            continue
+        built += build_stats(sha256) is not None
+    print(f"Profiled {built} files")
@@ -0,0 +1,385 @@
+import datetime
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+import blobstore
+import config
+from spreadsheets import iter_sheets
+
+CHUNK_ROWS = 10000
+STATS_CHUNK_ROWS = 1 << 16
+# 2: text is kept for every column, numbers only alongside it
+FORMAT_VERSION = 2
+
+# On-disk layout, one directory per blob hash:
+#
+#   <COLUMNAR_CACHE_FOLDER>/<sha256>/meta.json
+#   <COLUMNAR_CACHE_FOLDER>/<sha256>/s<sheet>/c<column>.off   int64 end offsets
+#   <COLUMNAR_CACHE_FOLDER>/<sha256>/s<sheet>/c<column>.dat   concatenated UTF-8 cell text
+#   <COLUMNAR_CACHE_FOLDER>/<sha256>/s<sheet>/c<column>.f8    float64 values (numeric columns)
+#
+# All files are raw little-endian arrays opened with np.memmap, so reading a
+# page touches only the bytes for the rows and columns asked for. Previews
+# always read the cell text; the float copy only feeds column statistics.
+
+
+def cache_dir(sha256):
+    return os.path.join(config.COLUMNAR_CACHE_FOLDER, sha256)
+
+
+def _to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+# Cells count as numbers only when they are plain decimals that survive a
+# float64 round trip: an optional leading "-", no leading zeros, exponents,
+# underscores or spaces, and at most MAX_NUMBER_DIGITS significant digits. Anything else ("00123", a
+# 19-digit account number, "1_000", "nan") is text.
+_DECIMAL = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?")
+MAX_NUMBER_DIGITS = 15
+
+
+def _to_number(value):
+    """float for numeric cells, NaN for empty ones; ValueError otherwise."""
+    if value is None or value == "":
+        return math.nan
+    if isinstance(value, str):
+        if not _DECIMAL.fullmatch(value):
+            raise ValueError(value)
+        if len(value.lstrip("-").replace(".", "").lstrip("0")) > MAX_NUMBER_DIGITS:
+            raise ValueError(value)
+        return float(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError(value)
+        return value
+    if isinstance(value, int) and not isinstance(value, bool) and abs(value) < 10 ** MAX_NUMBER_DIGITS:
+        return float(value)
+    raise ValueError(value)
+
+
+class _ColumnWriter:
+    """Streams one column's text to disk, plus a float copy while every cell is a number."""
+
+    def __init__(self, directory, index, rows_before):
+        self.prefix = os.path.join(directory, f"c{index}")
+        self.numeric = True
+        self.end = 0
+        self.nums = open(self.prefix + ".f8", "wb")
+        self.offs = open(self.prefix + ".off", "wb")
+        self.data = open(self.prefix + ".dat", "wb")
+        if rows_before:
+            self.append([None] * rows_before)
+
+    def append(self, values):
+        encoded = [_to_text(v).encode("utf-8") for v in values]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        ends = self.end + np.cumsum(lengths)
+        if len(ends):
+            self.end = int(ends[-1])
+        self.offs.write(ends.astype("<i8").tobytes())
+        self.data.write(b"".join(encoded))
+        if self.numeric:
+            try:
+                numbers = np.array([_to_number(v) for v in values], dtype="<f8")
+            except ValueError:
+                self.numeric = False
+                self.nums.close()
+                os.unlink(self.prefix + ".f8")
+            else:
+                self.nums.write(numbers.tobytes())
+
+    def finish(self):
+        for f in (self.nums, self.offs, self.data):
+            f.close()
+        return "number" if self.numeric else "text"
+
+
+def _unique_names(header):
+    names, seen = [], set()
+    for i, value in enumerate(header):
+        name = _to_text(value).strip() or f"column_{i + 1}"
+        base, n = name, 2
+        while name in seen:
+            name, n = f"{base}_{n}", n + 1
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _write_sheet(directory, rows):
+    os.makedirs(directory)
+    header = next(rows, [])
+    names = _unique_names(header)
+    writers = [_ColumnWriter(directory, i, 0) for i in range(len(names))]
+    row_count = 0
+
+    def flush(chunk):
+        for i, writer in enumerate(writers):
+            writer.append([row[i] if i < len(row) else None for row in chunk])
+
+    chunk = []
+    for row in rows:
+        if len(row) > len(writers):
+            # A row wider than the header: add columns, back-filled with empties.
+            flush(chunk)
+            row_count += len(chunk)
+            chunk = []
+            for i in range(len(writers), len(row)):
+                names.append(_unique_names(names + [None])[-1])
+                writers.append(_ColumnWriter(directory, i, row_count))
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            flush(chunk)
+            row_count += len(chunk)
+            chunk = []
+    flush(chunk)
+    row_count += len(chunk)
+
+    columns = [{"name": name, "type": writer.finish()} for name, writer in zip(names, writers)]
+    return {"rows": row_count, "columns": columns}
+
+
+def build_cache(sha256, kind):
+    """Parse a CSV/XLSX blob once into the columnar cache and return its meta.
+
+    A cache written in an older format is rebuilt and replaced.
+    """
+    target = cache_dir(sha256)
+    if os.path.exists(os.path.join(target, "meta.json")):
+        meta = load_meta(sha256)
+        if meta is not None:
+            return meta
+
+    os.makedirs(config.COLUMNAR_CACHE_FOLDER, exist_ok=True)
+    work = tempfile.mkdtemp(dir=config.COLUMNAR_CACHE_FOLDER, prefix=".build-")
+    try:
+        sheets = []
+        with blobstore.open_blob(sha256) as f:
+            for index, (name, rows) in enumerate(iter_sheets(f, kind)):
+                sheet = _write_sheet(os.path.join(work, f"s{index}"), rows)
+                sheet["name"] = name
+                sheets.append(sheet)
+        meta = {"version": FORMAT_VERSION, "sheets": sheets}
+        with open(os.path.join(work, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(work, target)
+        except OSError:
+            if load_meta(sha256) is not None:
+                # Another worker finished building the same blob first.
+                shutil.rmtree(work)
+            else:
+                stale = tempfile.mkdtemp(dir=config.COLUMNAR_CACHE_FOLDER, prefix=".stale-")
+                os.rename(target, os.path.join(stale, sha256))
+                os.rename(work, target)
+                shutil.rmtree(stale)
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    return meta
+
+
+@lru_cache(maxsize=256)
+def _cached_meta(sha256):
+    with open(os.path.join(cache_dir(sha256), "meta.json")) as f:
+        return json.load(f)
+
+
+def load_meta(sha256):
+    """The cache's meta.json, or None when it has not been built yet (or is outdated)."""
+    for attempt in range(2):
+        try:
+            meta = _cached_meta(sha256)
+        except FileNotFoundError:
+            return None
+        if meta.get("version") == FORMAT_VERSION:
+            return meta
+        # Possibly rebuilt by another process since we cached it.
+        _cached_meta.cache_clear()
+    return None
+
+
+def _memmap(path, dtype, count):
+    if count == 0 or os.path.getsize(path) == 0:
+        return np.zeros(count, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+def _read_column(prefix, rows, start, stop):
+    ends = _memmap(prefix + ".off", "<i8", rows)
+    first = int(ends[start - 1]) if start else 0
+    last = int(ends[stop - 1]) if stop > start else first
+    with open(prefix + ".dat", "rb") as f:
+        f.seek(first)
+        blob = f.read(last - first)
+    bounds = [0] + [int(e) - first for e in ends[start:stop]]
+    return [blob[bounds[i]:bounds[i + 1]].decode("utf-8") for i in range(stop - start)]
+
+
+def read_page(sha256, sheet=0, offset=0, limit=100, columns=None):
+    """Rows [offset, offset + limit) of one sheet, restricted to ``columns`` if given.
+
+    Returns None if the cache is not built; raises KeyError for an unknown
+    sheet or column.
+    """
+    meta = load_meta(sha256)
+    if meta is None:
+        return None
+    info = meta["sheets"][sheet] if 0 <= sheet < len(meta["sheets"]) else None
+    if info is None:
+        raise KeyError(f"sheet {sheet}")
+    by_name = {c["name"]: i for i, c in enumerate(info["columns"])}
+    unknown = [name for name in columns or () if name not in by_name]
+    if unknown:
+        raise KeyError(f"column {unknown[0]}")
+    wanted = [by_name[name] for name in columns] if columns else list(range(len(by_name)))
+
+    start = min(max(offset, 0), info["rows"])
+    stop = min(start + max(limit, 0), info["rows"])
+    directory = os.path.join(cache_dir(sha256), f"s{sheet}")
+    values = [
+        _read_column(os.path.join(directory, f"c{i}"), info["rows"], start, stop)
+        for i in wanted
+    ]
+    return {
+        "sheet": info["name"],
+        "sheets": [s["name"] for s in meta["sheets"]],
+        "columns": [info["columns"][i] for i in wanted],
+        "offset": start,
+        "total_rows": info["rows"],
+        "rows": [list(row) for row in zip(*values)] if values else [[] for _ in range(stop - start)],
+    }
+
+
+# HyperLogLog with 2**12 registers: about 1.6% standard error.
+HLL_PRECISION = 12
+
+
+class DistinctSketch:
+    """HyperLogLog distinct-value estimate over 64-bit hashes, updated a chunk at a time."""
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes):
+        if not len(hashes):
+            return
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        # Rank = position of the first 1 bit after the index bits; the guard
+        # bit caps it for hashes whose remaining bits are all zero.
+        rest = (hashes << np.uint64(p)) | np.uint64(1 << (p - 1))
+        rank = (64 - np.floor(np.log2(rest.astype(np.float64)))).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int32))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * math.log(m / zeros)))  # linear counting for small sets
+        return int(round(raw))
+
+
+def _mix(values):
+    """splitmix64 finalizer over float64 bit patterns (0.0 and -0.0 hash alike)."""
+    bits = (values + 0.0).view(np.uint64)
+    bits = (bits ^ (bits >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    bits = (bits ^ (bits >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return bits ^ (bits >> np.uint64(31))
+
+
+def _number_stats(values, rows):
+    sketch = DistinctSketch()
+    count, total = 0, 0.0
+    low, high = math.inf, -math.inf
+    integral = True
+    for start in range(0, rows, STATS_CHUNK_ROWS):
+        chunk = np.asarray(values[start:start + STATS_CHUNK_ROWS])
+        chunk = chunk[~np.isnan(chunk)]
+        if not len(chunk):
+            continue
+        count += len(chunk)
+        total += float(chunk.sum())
+        low, high = min(low, float(chunk.min())), max(high, float(chunk.max()))
+        integral = integral and bool(np.all(chunk == np.floor(chunk)))
+        sketch.add(_mix(chunk))
+    if not count:
+        return {"dtype": "empty", "nulls": rows, "distinct": 0}
+
+    def number(value):
+        return int(value) if integral and abs(value) < 2 ** 53 else value
+
+    return {
+        "dtype": "integer" if integral else "float",
+        "nulls": rows - count,
+        "distinct": sketch.estimate(),
+        "min": number(low),
+        "max": number(high),
+        "sum": number(total),
+        "mean": total / count,
+    }
+
+
+def _text_stats(ends, data, rows):
+    import pandas as pd
+
+    sketch = DistinctSketch()
+    nulls = 0
+    for start in range(0, rows, STATS_CHUNK_ROWS):
+        stop = min(start + STATS_CHUNK_ROWS, rows)
+        chunk_ends = np.asarray(ends[start:stop])
+        first = int(ends[start - 1]) if start else 0
+        lengths = np.diff(chunk_ends, prepend=first)
+        nulls += int(np.count_nonzero(lengths == 0))
+        text = np.asarray(data[first:int(chunk_ends[-1])]).tobytes()
+        bounds = (chunk_ends - first)[lengths > 0]
+        starts = bounds - lengths[lengths > 0]
+        cells = np.array([text[a:b] for a, b in zip(starts.tolist(), bounds.tolist())], dtype=object)
+        if len(cells):
+            sketch.add(pd.util.hash_array(cells))
+    if nulls == rows:
+        return {"dtype": "empty", "nulls": rows, "distinct": 0}
+    return {"dtype": "text", "nulls": nulls, "distinct": sketch.estimate()}
+
+
+def column_stats(sha256):
+    """Profile every column in the cache: dtype, nulls, distinct estimate and,
+    for numbers, min/max/sum/mean. None if the cache is not built.
+
+    Columns are scanned STATS_CHUNK_ROWS at a time straight from the memory
+    maps, so memory use does not grow with the file.
+    """
+    meta = load_meta(sha256)
+    if meta is None:
+        return None
+    sheets = []
+    for sheet, info in enumerate(meta["sheets"]):
+        rows = info["rows"]
+        directory = os.path.join(cache_dir(sha256), f"s{sheet}")
+        columns = []
+        for index, column in enumerate(info["columns"]):
+            prefix = os.path.join(directory, f"c{index}")
+            if column["type"] == "number":
+                stats = _number_stats(_memmap(prefix + ".f8", "<f8", rows), rows)
+            else:
+                ends = _memmap(prefix + ".off", "<i8", rows)
+                data = _memmap(prefix + ".dat", "u1", int(ends[-1]) if rows else 0)
+                stats = _text_stats(ends, data, rows)
+            columns.append(dict(stats, name=column["name"]))
+        sheets.append({"name": info["name"], "rows": rows, "columns": columns})
+    return {"version": 1, "sheets": sheets}
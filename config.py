@@ -0,0 +1,146 @@
+import os
+
+# Storage locations. Everything lives under DATA_DIR (default: this
+# directory) as absolute paths, so workers do not depend on the cwd.
+# create_app({"DATA_DIR": ...}) moves all of them at once via configure().
+DATA_DIR = os.path.abspath(os.getenv("SDIRA_DATA_DIR", os.path.dirname(os.path.abspath(__file__))))
+
+
+def storage_paths(data_dir):
+    """Every storage location derived from ``data_dir``."""
+    storage = os.path.join(data_dir, "storage")
+    uploads = os.path.join(data_dir, "uploads")
+    return {
+        "DATA_DIR": data_dir,
+        "STORAGE_FOLDER": storage,
+        "UPLOAD_FOLDER": uploads,
+        "USER_FILE": os.path.join(storage, "users.json"),
+        "FILES_JSON_PATH": os.path.join(storage, "files.json"),
+        "FILES_MSGPACK_PATH": os.path.join(storage, "files.msgpack"),
+        "METADATA_DB_PATH": os.getenv("METADATA_DB_PATH", os.path.join(storage, "metadata.sqlite3")),
+        # In-progress chunked uploads are spooled here, on the same
+        # filesystem as UPLOAD_FOLDER so finalizing is a rename.
+        "PARTIAL_UPLOAD_FOLDER": os.path.join(uploads, ".partial"),
+        # Uploaded content is stored once per SHA-256 under this folder.
+        "BLOB_FOLDER": os.path.join(uploads, "blobs"),
+        "JOBS_DB_PATH": os.getenv("JOBS_DB_PATH", os.path.join(storage, "jobs.sqlite3")),
+        # Parsed, memory-mappable copies of spreadsheets for previews
+        "COLUMNAR_CACHE_FOLDER": os.path.join(storage, "columnar"),
+        # Full-text index of spreadsheet cells (content_index.py)
+        "CONTENT_INDEX_PATH": os.getenv("CONTENT_INDEX_PATH", os.path.join(storage, "content.sqlite3")),
+        # History of re-uploaded files (versions.py)
+        "VERSIONS_DB_PATH": os.getenv("VERSIONS_DB_PATH", os.path.join(storage, "versions.sqlite3")),
+        # Counter bumped on every change a dashboard shows (render_cache.py)
+        "CATALOG_GENERATION_PATH": os.path.join(storage, "catalog.generation"),
+        "METRICS_PROFILE_DIR": os.getenv("METRICS_PROFILE_DIR", os.path.join(storage, "profiles")),
+    }
+
+
+_paths = storage_paths(DATA_DIR)
+STORAGE_FOLDER = _paths["STORAGE_FOLDER"]
+UPLOAD_FOLDER = _paths["UPLOAD_FOLDER"]
+USER_FILE = _paths["USER_FILE"]
+FILES_JSON_PATH = _paths["FILES_JSON_PATH"]
+FILES_MSGPACK_PATH = _paths["FILES_MSGPACK_PATH"]
+METADATA_DB_PATH = _paths["METADATA_DB_PATH"]
+PARTIAL_UPLOAD_FOLDER = _paths["PARTIAL_UPLOAD_FOLDER"]
+BLOB_FOLDER = _paths["BLOB_FOLDER"]
+JOBS_DB_PATH = _paths["JOBS_DB_PATH"]
+COLUMNAR_CACHE_FOLDER = _paths["COLUMNAR_CACHE_FOLDER"]
+CONTENT_INDEX_PATH = _paths["CONTENT_INDEX_PATH"]
+VERSIONS_DB_PATH = _paths["VERSIONS_DB_PATH"]
+CATALOG_GENERATION_PATH = _paths["CATALOG_GENERATION_PATH"]
+METRICS_PROFILE_DIR = _paths["METRICS_PROFILE_DIR"]
+
+# Settings changed through configure(); job pool processes re-apply them.
+OVERRIDES = {}
+
+# File metadata backend: "sqlite" (default), "json" or "msgpack"
+METADATA_BACKEND = os.getenv("METADATA_BACKEND", "sqlite")
+
+# Uploads larger than this are rejected (bytes); also applied to form posts.
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 1024 * 1024 * 1024))
+# Seconds an unfinished chunked upload may sit idle before `python
+# blobstore.py gc` deletes it.
+PARTIAL_UPLOAD_TTL = int(os.getenv("PARTIAL_UPLOAD_TTL", 24 * 3600))
+# Most files one /upload/batch request (multipart parts or ZIP members) may add,
+# and the largest /upload/batch request body (other requests are bounded by
+# MAX_UPLOAD_SIZE; each file in a batch still is).
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 1000))
+BATCH_MAX_REQUEST_SIZE = int(os.getenv("BATCH_MAX_REQUEST_SIZE", 16 * MAX_UPLOAD_SIZE))
+# Limits on an uploaded ZIP: the total size of its members once decompressed,
+# and the largest compression ratio accepted for members over 1 MiB.
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", BATCH_MAX_REQUEST_SIZE))
+BATCH_MAX_RATIO = int(os.getenv("BATCH_MAX_RATIO", 200))
+
+# Background post-upload processing. JOB_WORKERS=0 runs jobs inline.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+
+# Previews return at most this many rows per request
+PREVIEW_MAX_ROWS = int(os.getenv("PREVIEW_MAX_ROWS", 500))
+
+# Re-uploading a file adds a version. Superseded CSV versions are kept as
+# row deltas against the previous one, except that every
+# VERSION_SNAPSHOT_EVERY-th is stored whole (bounding how many deltas a
+# download replays) and so is any whose delta exceeds
+# VERSION_DELTA_MAX_RATIO of the file's size.
+VERSION_SNAPSHOT_EVERY = int(os.getenv("VERSION_SNAPSHOT_EVERY", 10))
+VERSION_DELTA_MAX_RATIO = float(os.getenv("VERSION_DELTA_MAX_RATIO", 0.5))
+
+# `python blobstore.py compress` gzips blobs untouched for COLD_STORAGE_DAYS
+# (run it from cron). Compressed blobs are kept only if they shrink to at
+# most COLD_STORAGE_MAX_RATIO of their size.
+COLD_STORAGE_DAYS = float(os.getenv("COLD_STORAGE_DAYS", 30))
+COLD_STORAGE_LEVEL = int(os.getenv("COLD_STORAGE_LEVEL", 6))
+COLD_STORAGE_MAX_RATIO = float(os.getenv("COLD_STORAGE_MAX_RATIO", 0.9))
+
+# Downloads: "" serves files from Python (sendfile via wsgi.file_wrapper),
+# "x-sendfile" or "x-accel-redirect" hands them to a fronting proxy.
+DOWNLOAD_OFFLOAD = os.getenv("DOWNLOAD_OFFLOAD", "")
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "/protected-uploads")
+MAX_DOWNLOAD_RANGES = 16
+
+# Password hashing runs on its own bounded thread pool. Logins beyond
+# PASSWORD_WORKERS running + PASSWORD_QUEUE_LIMIT waiting are turned away
+# with 503; hashes not using PASSWORD_HASH_METHOD are upgraded on login.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 16))
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+# Seconds a failed (username, password) pair is rejected without re-hashing
+PASSWORD_FAILURE_TTL = int(os.getenv("PASSWORD_FAILURE_TTL", 300))
+
+# File listings (dashboards and /issuer/files) are paginated by cursor.
+FILES_PAGE_SIZE = int(os.getenv("FILES_PAGE_SIZE", 50))
+MAX_FILES_PAGE_SIZE = int(os.getenv("MAX_FILES_PAGE_SIZE", 500))
+
+# Rendered dashboard file lists are cached per user and page in each worker,
+# up to this many bytes of HTML, least recently used evicted first.
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Request metrics are served at /metrics. When METRICS_PROFILE_RATE > 0 that
+# fraction of requests runs under cProfile and the METRICS_PROFILE_KEEP
+# slowest are kept as .prof files in METRICS_PROFILE_DIR (see storage_paths).
+METRICS_PROFILE_RATE = float(os.getenv("METRICS_PROFILE_RATE", 0))
+METRICS_PROFILE_KEEP = int(os.getenv("METRICS_PROFILE_KEEP", 20))
+
+# PRELOAD=1 makes wsgi.py warm the user, metadata and access caches (and
+# import the parsing libraries) once in the master, before workers fork.
+PRELOAD = os.getenv("PRELOAD", "") == "1"
+
+
+def configure(overrides):
+    """Replace settings in this module; a new DATA_DIR moves every storage path.
+
+    Must run before the stores and queues are first used (create_app()
+    calls it), since they read their paths when created.
+    """
+    overrides = dict(overrides)
+    unknown = [name for name in overrides if name not in globals() or not name.isupper()]
+    if unknown:
+        raise KeyError(f"Unknown settings: {', '.join(unknown)}")
+    if "DATA_DIR" in overrides:
+        overrides["DATA_DIR"] = os.path.abspath(overrides["DATA_DIR"])
+        paths = storage_paths(overrides["DATA_DIR"])
+        globals().update({name: value for name, value in paths.items() if name not in overrides})
+    globals().update(overrides)
+    OVERRIDES.update(overrides)
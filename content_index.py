@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+import config
+
+# Each spreadsheet row is one FTS5 document whose rowid packs
+# (blob, sheet, row), so a hit needs no lookup table:
+#
+#   rowid = blob_id << 32 | sheet << 24 | row
+#
+# Rows past MAX_ROWS in a sheet, and sheets past MAX_SHEETS, are not indexed.
+ROW_BITS = 24
+MAX_ROWS = 1 << ROW_BITS
+MAX_SHEETS = 1 << (32 - ROW_BITS)
+
+# Users who can see at most this many files have their blobs searched one by
+# one; everyone else scans all hits and drops the ones they cannot see.
+SCAN_VISIBLE_FILES = 256
+
+# Kept in PRAGMA user_version. 2: rows are indexed from the original cell
+# text; an index written from older, number-coerced caches is emptied when
+# opened and refilled by `python content_index.py`.
+FORMAT_VERSION = 2
+
+
+def _rowid(blob_id, sheet, row):
+    return (blob_id << 32) | (sheet << ROW_BITS) | row
+
+
+def _split_rowid(rowid):
+    return rowid >> 32, (rowid >> ROW_BITS) & (MAX_SHEETS - 1), rowid & (MAX_ROWS - 1)
+
+
+def match_query(text):
+    """FTS5 query that requires every word of ``text``, each as a phrase.
+
+    Quoting keeps FTS5 operators out of user input; a word like
+    "XXX-XX-1234" becomes the phrase xxx xx 1234, so the tokens must appear
+    next to each other in a cell.
+    """
+    words = [w for w in text.split() if any(c.isalnum() for c in w)]
+    return " ".join('"' + w.replace('"', '""') + '"' for w in words)
+
+
+def _row_text(row):
+    return " ".join(str(value) for value in row if value is not None and value != "")
+
+
+class ContentIndex:
+    """Full-text index of spreadsheet cells, kept in its own SQLite file.
+
+    Rows are indexed per content blob, so a file uploaded twice is indexed
+    once. The FTS5 table is contentless (the text lives in the blobs and
+    columnar caches already); SQLite merges its segments incrementally as
+    blobs are added.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            id INTEGER PRIMARY KEY,
+            sha256 TEXT NOT NULL UNIQUE,
+            sheets TEXT NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS cells USING fts5(
+            text, content='', columnsize=0, tokenize='unicode61 remove_diacritics 2'
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+        self._upgrade()
+
+    def _upgrade(self):
+        conn = self._connect()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= FORMAT_VERSION:
+            return
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < FORMAT_VERSION:
+                conn.execute("INSERT INTO cells (cells) VALUES ('delete-all')")
+                conn.execute("DELETE FROM blobs")
+                conn.execute(f"PRAGMA user_version = {FORMAT_VERSION}")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def is_indexed(self, sha256):
+        row = self._connect().execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        return row is not None
+
+    def index_blob(self, sha256):
+        """Index every row of a blob from its columnar cache; returns the row count.
+
+        The cache keeps each cell's original text, so "00123" is found as
+        00123, not 123. Returns 0 if the blob is already indexed or has no
+        cache.
+        """
+        import columnar
+
+        meta = columnar.load_meta(sha256)
+        if meta is None or self.is_indexed(sha256):
+            return 0
+        sheets = [s["name"] for s in meta["sheets"][:MAX_SHEETS]]
+        indexed = 0
+        try:
+            with self._connect() as conn:
+                blob_id = conn.execute(
+                    "INSERT INTO blobs (sha256, sheets) VALUES (?, ?)", (sha256, json.dumps(sheets))
+                ).lastrowid
+                for sheet, info in enumerate(meta["sheets"][:MAX_SHEETS]):
+                    rows = min(info["rows"], MAX_ROWS)
+                    for offset in range(0, rows, columnar.CHUNK_ROWS):
+                        page = columnar.read_page(sha256, sheet, offset, min(columnar.CHUNK_ROWS, rows - offset))
+                        conn.executemany(
+                            "INSERT INTO cells (rowid, text) VALUES (?, ?)",
+                            (
+                                (_rowid(blob_id, sheet, offset + i), _row_text(row))
+                                for i, row in enumerate(page["rows"])
+                            ),
+                        )
+                        indexed += len(page["rows"])
+        except sqlite3.IntegrityError:
+            # Another job indexed the same blob first.
+            return 0
+        return indexed
+
+    def hits(self, text, sha256s=None):
+        """Yield (sha256, sheet name, sheet index, row) for rows matching ``text``.
+
+        With ``sha256s`` only those blobs are searched, each through a rowid
+        range; otherwise hits come from every blob, oldest blob first.
+        """
+        query = match_query(text)
+        if not query:
+            return
+        conn = self._connect()
+        if sha256s is None:
+            blobs = {}
+            rows = conn.execute("SELECT rowid FROM cells WHERE cells MATCH ? ORDER BY rowid", (query,))
+            for (rowid,) in rows:
+                blob_id, sheet, row = _split_rowid(rowid)
+                if blob_id not in blobs:
+                    blobs[blob_id] = conn.execute(
+                        "SELECT sha256, sheets FROM blobs WHERE id = ?", (blob_id,)
+                    ).fetchone()
+                sha256, sheets = blobs[blob_id]
+                yield sha256, json.loads(sheets)[sheet], sheet, row
+            return
+
+        sha256s = list(sha256s)
+        blobs = []
+        for start in range(0, len(sha256s), 500):
+            chunk = sha256s[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            blobs += conn.execute(
+                "SELECT id, sha256, sheets FROM blobs WHERE sha256 IN (" + placeholders + ")", chunk
+            ).fetchall()
+        for blob_id, sha256, sheets in sorted(blobs):
+            sheets = json.loads(sheets)
+            rows = conn.execute(
+                "SELECT rowid FROM cells WHERE cells MATCH ? AND rowid >= ? AND rowid < ? ORDER BY rowid",
+                (query, _rowid(blob_id, 0, 0), _rowid(blob_id + 1, 0, 0)),
+            )
+            for (rowid,) in rows:
+                _, sheet, row = _split_rowid(rowid)
+                yield sha256, sheets[sheet], sheet, row
+
+    def search(self, store, visible_ids, text, limit=50):
+        """Matching rows in files among ``visible_ids`` (acl.readable_ids()).
+
+        Returns (hits, truncated): up to ``limit`` (record, sheet name, sheet
+        index, row) tuples, and whether more were left.
+        """
+        files_by_blob = {}
+        if len(visible_ids) <= SCAN_VISIBLE_FILES:
+            for record in store.files_by_ids(sorted(visible_ids)):
+                if record.get("sha256"):
+                    files_by_blob.setdefault(record["sha256"], []).append(record)
+            hits = self.hits(text, files_by_blob)
+        else:
+            hits = self.hits(text)
+
+        found = []
+        for sha256, sheet_name, sheet, row in hits:
+            if sha256 not in files_by_blob:
+                files_by_blob[sha256] = [
+                    r for r in store.files_with_blob(sha256) if r["id"] in visible_ids
+                ]
+            for record in files_by_blob[sha256]:
+                if len(found) == limit:
+                    return found, True
+                found.append((record, sheet_name, sheet, row))
+        return found, False
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_content_index():
+    """Return the process-wide ContentIndex."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ContentIndex(config.CONTENT_INDEX_PATH)
+    return _index
+
+
+if __name__ == "__main__":
+    # python content_index.py  -- index spreadsheets uploaded before the content index existed
+    import columnar
+    from metadata_store import get_store
+    from spreadsheets import file_kind
+
+    index = get_content_index()
+    rows = 0
+    for record in get_store().all_files():
+        sha256, kind = record.get("sha256"), file_kind(record["filename"])
+        if not sha256 or kind not in ("csv", "xlsx") or index.is_indexed(sha256):
+            continue
+        try:
+            columnar.build_cache(sha256, kind)
+        except Exception as e:
+            print(f"Skipping {record['filename']}: {e}", file=sys.stderr)
+            continue
+        rows += index.index_blob(sha256)
+    print(f"Indexed {rows} rows")
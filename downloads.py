@@ -0,0 +1,304 @@
+import gzip
+import os
+import uuid
+import zipfile
+from datetime import datetime, timezone
+
+from flask import Response, request, send_file
+from werkzeug.http import http_date, is_resource_modified, parse_range_header
+
+import blobstore
+import config
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# Formats that are already compressed containers; deflating them again
+# costs CPU and saves nothing.
+STORED_EXTENSIONS = {"xlsx", "zip", "gz"}
+
+
+def _last_modified(record, path):
+    if record and record.get("upload_time"):
+        return datetime.fromisoformat(record["upload_time"]).replace(tzinfo=timezone.utc, microsecond=0)
+    return datetime.fromtimestamp(int(os.path.getmtime(path)), timezone.utc)
+
+
+def _if_range_matches(etag, last_modified):
+    """True if there is no If-Range header or it still describes this file."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return etag is not None and if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified <= if_range.date
+    return True
+
+
+def _satisfiable_ranges(size):
+    """Normalised, merged (start, stop) byte ranges from the Range header.
+
+    Returns None when the header is absent or should be ignored (then the
+    whole file is sent), and [] when no range can be satisfied.
+    """
+    parsed = parse_range_header(request.headers.get("Range"))
+    if parsed is None or parsed.units != "bytes" or len(parsed.ranges) > config.MAX_DOWNLOAD_RANGES:
+        return None
+    ranges = []
+    for start, stop in parsed.ranges:
+        if stop is None:
+            stop = size
+            if start < 0:
+                start = max(size + start, 0)
+        stop = min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def _iter_range(path, start, stop):
+    # Compressed blobs seek by decompressing up to ``start``, in bounded memory.
+    with blobstore.open_path(path) as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def _range_response(path, ranges, size, mimetype):
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = Response(_iter_range(path, start, stop), 206, mimetype=mimetype, direct_passthrough=True)
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response.content_length = stop - start
+        return response
+
+    boundary = uuid.uuid4().hex
+    heads = [
+        (f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode("ascii")
+        for start, stop in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    def generate():
+        for head, (start, stop) in zip(heads, ranges):
+            yield head
+            yield from _iter_range(path, start, stop)
+        yield tail
+
+    response = Response(
+        generate(), 206, content_type=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True
+    )
+    response.content_length = sum(map(len, heads)) + sum(stop - start for start, stop in ranges) + len(tail)
+    return response
+
+
+def _partial_response(path, size, download_name, mimetype, etag, last_modified):
+    """A 206/416 answer to the request's Range header, or None to send the whole file.
+
+    ``size`` is that of the original bytes. A Range that loses to
+    If-None-Match/If-Modified-Since or is ignored is removed from the
+    environ so the caller's conditional handling does not see it.
+    """
+    if not request.headers.get("Range"):
+        return None
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        # If-None-Match/If-Modified-Since win over Range; send_file
+        # would answer 206 instead of 304.
+        request.environ.pop("HTTP_RANGE", None)
+        return None
+    if not _if_range_matches(etag, last_modified):
+        return None
+    ranges = _satisfiable_ranges(size)
+    if ranges is None:
+        # A Range header we choose to ignore: answer with the whole
+        # file rather than letting send_file reject it.
+        request.environ.pop("HTTP_RANGE", None)
+        return None
+    if not ranges:
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+    response = _range_response(path, ranges, size, mimetype)
+    response.headers.set("Content-Disposition", "attachment", filename=download_name)
+    if etag:
+        response.set_etag(etag)
+    response.headers["Last-Modified"] = http_date(last_modified)
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _offload_response(path, download_name, mimetype, etag, last_modified):
+    """Empty response telling nginx to serve the file itself (X-Accel-Redirect)."""
+    relative = os.path.relpath(path, config.UPLOAD_FOLDER).replace(os.sep, "/")
+    response = Response(mimetype=mimetype)
+    response.headers["X-Accel-Redirect"] = config.X_ACCEL_PREFIX.rstrip("/") + "/" + relative
+    response.headers.set("Content-Disposition", "attachment", filename=download_name)
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(request.environ)
+
+
+def send_stored_file(path, download_name, record=None):
+    """Send an uploaded file with validators, conditional GET and byte ranges.
+
+    The blob hash is a strong ETag, so unchanged files come back as 304.
+    Whole-file responses go through wsgi.file_wrapper, which servers such as
+    gunicorn implement with sendfile(2); DOWNLOAD_OFFLOAD can instead hand
+    the file to a fronting proxy via X-Sendfile or X-Accel-Redirect.
+    Compressed (cold) blobs go through send_compressed().
+    """
+    # send_file resolves relative paths against the app root, not the cwd.
+    path = os.path.abspath(path)
+    if blobstore.is_compressed(path):
+        return send_compressed(path, download_name, record)
+    etag = record.get("sha256") if record else None
+    mimetype = (record or {}).get("mime_type") or "application/octet-stream"
+    last_modified = _last_modified(record, path)
+
+    if config.DOWNLOAD_OFFLOAD == "x-accel-redirect":
+        return _offload_response(path, download_name, mimetype, etag, last_modified)
+
+    if config.DOWNLOAD_OFFLOAD != "x-sendfile":
+        response = _partial_response(path, os.path.getsize(path), download_name, mimetype, etag, last_modified)
+        if response is not None:
+            return response
+
+    # Conditional GET and whole-file sends (file_wrapper / X-Sendfile).
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name,
+        conditional=True,
+        etag=etag if etag else True,
+        last_modified=last_modified,
+    )
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+
+def send_stream(chunks, download_name, record):
+    """Send content generated on the fly (e.g. a version rebuilt from deltas).
+
+    The record's sha256 and size still give a strong ETag and a
+    Content-Length, so conditional GETs work; byte ranges do not.
+    """
+    mimetype = record.get("mime_type") or "application/octet-stream"
+    response = Response(chunks, mimetype=mimetype, direct_passthrough=True)
+    response.headers.set("Content-Disposition", "attachment", filename=download_name)
+    if record.get("size") is not None:
+        response.content_length = record["size"]
+    if record.get("sha256"):
+        response.set_etag(record["sha256"])
+    response.last_modified = _last_modified(record, None)
+    return response.make_conditional(request.environ)
+
+
+def _iter_gunzip(path):
+    with gzip.open(path, "rb") as f:
+        yield from iter(lambda: f.read(READ_BLOCK_SIZE), b"")
+
+
+def send_compressed(path, download_name, record):
+    """Send a gzipped blob: as-is to clients accepting gzip, inflated for the rest.
+
+    Gzip clients get the stored bytes with Content-Encoding: gzip (and a
+    distinct ETag, since the representation differs), ranges counting those
+    bytes. Everyone else gets the original bytes decompressed block by
+    block, ranges counting the original bytes.
+    """
+    mimetype = record.get("mime_type") or "application/octet-stream"
+    last_modified = _last_modified(record, path)
+    if request.accept_encodings.quality("gzip") > 0:
+        etag = f"{record['sha256']}-gzip"
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            request.environ.pop("HTTP_RANGE", None)  # 304, not 206
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+            etag=etag,
+            last_modified=last_modified,
+        )
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = None
+        if record.get("size") is not None:
+            response = _partial_response(
+                path, record["size"], download_name, mimetype, record["sha256"], last_modified
+            )
+        if response is None:
+            response = send_stream(_iter_gunzip(path), download_name, record)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+class _ZipSink:
+    """Write-only file object that hands everything written to a generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive of ``entries`` as it is built, in constant memory.
+
+    ``entries`` is an iterable of (arcname, path, modified datetime, size),
+    ``size`` being that of the original bytes (paths may be compressed
+    blobs, see blobstore.open_path()). Nothing
+    is written to disk: because the sink cannot seek, zipfile emits a data
+    descriptor after each member instead of patching its local header.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for arcname, path, modified, size in entries:
+            info = zipfile.ZipInfo(arcname, modified.timetuple()[:6])
+            extension = arcname.rsplit(".", 1)[-1].lower()
+            info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with blobstore.open_path(path) as src, archive.open(info, "w", force_zip64=size > zipfile.ZIP64_LIMIT) as dst:
+                for block in iter(lambda: src.read(READ_BLOCK_SIZE), b""):
+                    dst.write(block)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def send_zip(records, download_name):
+    """Stream the given file records as a ZIP laid out as <issuer>/<filename>."""
+    def entries():
+        for record in records:
+            path = blobstore.file_path(record)
+            if os.path.exists(path):
+                # The record keeps the original size; a .gz on disk is smaller.
+                size = record.get("size") or os.path.getsize(path)
+                yield f"{record['issuer']}/{record['filename']}", path, _last_modified(record, path), size
+
+    response = Response(stream_zip(entries()), mimetype="application/zip", direct_passthrough=True)
+    response.headers.set("Content-Disposition", "attachment", filename=download_name)
+    return response
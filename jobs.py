@@ -0,0 +1,233 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import blobstore
+import config
+from content_index import get_content_index
+from render_cache import bump_generation
+from spreadsheets import file_kind
+from versions import store_version
+
+
+def process_upload(sha256, filename, record_id=None, version=None):
+    """Post-upload work: verify the checksum, build the preview cache, column
+    statistics and content index entries for spreadsheets and, for a new
+    version of an existing file, decide how that version is stored."""
+    hasher = hashlib.sha256()
+    with blobstore.open_blob(sha256) as f:
+        for block in iter(lambda: f.read(blobstore.READ_BLOCK_SIZE), b""):
+            hasher.update(block)
+    if hasher.hexdigest() != sha256:
+        raise ValueError("Stored content does not match its checksum")
+
+    result = {"checksum": sha256, "sheets": []}
+    kind = file_kind(filename)
+    if kind in ("csv", "xlsx"):
+        import columnar  # numpy/openpyxl are only needed by workers that parse
+        from column_stats import build_stats
+
+        meta = columnar.build_cache(sha256, kind)
+        build_stats(sha256)
+        result["sheets"] = [
+            {"name": s["name"], "rows": s["rows"], "columns": len(s["columns"])} for s in meta["sheets"]
+        ]
+        result["indexed_rows"] = get_content_index().index_blob(sha256)
+    if version is not None:
+        result["version"] = version
+        result["stored"] = store_version(record_id, version, filename)
+    return result
+
+
+# Job kinds that may be enqueued; the values run inside pool processes.
+TASKS = {
+    "process_upload": process_upload,
+}
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+
+
+def _set_state(conn, job_id, status, result=None, error=None):
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?",
+            (status, None if result is None else json.dumps(result), error, _now(), job_id),
+        )
+    # Dashboards show each file's job status.
+    bump_generation()
+
+
+def run_job(db_path, job_id, kind, args):
+    """Entry point in the pool process; records its own progress in the jobs table."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        _set_state(conn, job_id, "running")
+        try:
+            result = TASKS[kind](**args)
+        except Exception as e:
+            _set_state(conn, job_id, "failed", error=f"{type(e).__name__}: {e}")
+            return "failed"
+        _set_state(conn, job_id, "done", result=result)
+        return "done"
+    finally:
+        conn.close()
+
+
+class JobQueue:
+    """Persistent background jobs executed by a process pool.
+
+    Job state lives in SQLite so any worker can answer /jobs/<id> and jobs
+    left queued by a dead worker are picked up again by resume_pending().
+    With ``workers=0`` jobs run inline, which is handy for development.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            file_id INTEGER,
+            status TEXT NOT NULL,
+            args TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            created TEXT NOT NULL,
+            updated TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_file ON jobs(file_id, created);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status);
+    """
+
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        self._local = threading.local()
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _executor(self, replace=False):
+        # Pools do not survive fork, so each worker process starts its own.
+        # "spawn" keeps the children from inheriting open SQLite handles;
+        # they re-import config, so create_app() overrides are passed along.
+        with self._pool_lock:
+            if replace or self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=config.configure,
+                    initargs=(dict(config.OVERRIDES),),
+                )
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _submit(self, job_id, kind, args):
+        if self.workers == 0:
+            run_job(self.path, job_id, kind, args)
+            return
+        try:
+            future = self._executor().submit(run_job, self.path, job_id, kind, args)
+        except BrokenProcessPool:
+            future = self._executor(replace=True).submit(run_job, self.path, job_id, kind, args)
+
+        def on_done(future):
+            if future.exception() is not None:
+                # The pool itself broke (e.g. a child was killed).
+                conn = sqlite3.connect(self.path, timeout=30)
+                try:
+                    _set_state(conn, job_id, "failed", error=repr(future.exception()))
+                finally:
+                    conn.close()
+
+        future.add_done_callback(on_done)
+
+    def enqueue(self, kind, file_id=None, **args):
+        """Persist a job and hand it to the pool, returning its id."""
+        if kind not in TASKS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = uuid.uuid4().hex
+        now = _now()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, file_id, status, args, created, updated)"
+                " VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, file_id, json.dumps(args), now, now),
+            )
+        self._submit(job_id, kind, args)
+        return job_id
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["args"] = json.loads(job["args"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def statuses_for_files(self, file_ids):
+        """Status of the most recent job for each file id that has one."""
+        file_ids = list(file_ids)
+        if not file_ids:
+            return {}
+        placeholders = ", ".join("?" * len(file_ids))
+        rows = self._connect().execute(
+            "SELECT file_id, status FROM jobs WHERE file_id IN (" + placeholders + ")"
+            " ORDER BY created, rowid",
+            file_ids,
+        )
+        return {file_id: status for file_id, status in rows}
+
+    def resume_pending(self):
+        """Resubmit jobs that were queued or running when their worker died."""
+        rows = self._connect().execute(
+            "SELECT id, kind, args FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchall()
+        for job_id, kind, args in rows:
+            self._submit(job_id, kind, json.loads(args))
+        return len(rows)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Return the process-wide JobQueue."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue(config.JOBS_DB_PATH, config.JOB_WORKERS)
+    return _queue
+
+
+if __name__ == "__main__":
+    # python jobs.py  -- resubmit jobs orphaned by a crashed or restarted worker
+    queue = JobQueue(config.JOBS_DB_PATH, config.JOB_WORKERS)
+    print(f"Resubmitted {queue.resume_pending()} jobs")
+    if queue._pool is not None:
+        queue._pool.shutdown(wait=True)
@@ -0,0 +1,151 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+class CorruptStoreError(Exception):
+    """Raised when a JSON store exists but cannot be parsed."""
+
+
+def _json_loads(data):
+    return json.loads(data)
+
+
+def _json_dumps(data):
+    return json.dumps(data, indent=4).encode("utf-8")
+
+
+@contextmanager
+def file_lock(path, exclusive=True):
+    """Hold a cross-process lock on ``path`` via a sidecar ``.lock`` file.
+
+    The sidecar is never replaced, so the lock survives the rename that
+    atomic_write_json uses to commit the data file itself.
+    """
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def read_json(path, default, loads=_json_loads):
+    """Read a JSON store, returning ``default`` only if it does not exist yet.
+
+    ``loads`` turns the file's bytes into data; pass another codec (see
+    models.py) to read MessagePack or to decode into typed records. Any
+    ValueError it raises is reported as CorruptStoreError.
+    """
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return default
+    try:
+        return loads(raw)
+    except ValueError as e:
+        # Commits are atomic, so a parse failure is real damage; never let
+        # it masquerade as an empty store that the next write would persist.
+        raise CorruptStoreError(f"{path} could not be decoded: {e}") from e
+
+
+def atomic_write_json(path, data, dumps=_json_dumps):
+    """Write ``data`` to a temp file, fsync it and rename it over ``path``."""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(dumps(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    # Persist the rename itself.
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def update_json(path, mutate, default, loads=_json_loads, dumps=_json_dumps):
+    """Locked read-modify-write of a JSON store.
+
+    ``mutate`` receives the current data, changes it in place and returns a
+    result for the caller. Returning ``False`` skips the write.
+    """
+    with file_lock(path):
+        data = read_json(path, default, loads)
+        result = mutate(data)
+        if result is not False:
+            atomic_write_json(path, data, dumps)
+    return result
+
+
+class GroupCommitter:
+    """Batch concurrent updates to one JSON store into a single commit.
+
+    Threads calling submit() while a commit is in flight queue up behind
+    it; the next thread through takes the whole queue and writes it with
+    one lock acquisition and one fsync. ``apply(data, items)`` mutates the
+    loaded data and returns one result per item.
+    """
+
+    def __init__(self, path, apply, default, loads=_json_loads, dumps=_json_dumps):
+        self.path = path
+        self._apply = apply
+        self._default = default
+        self._loads = loads
+        self._dumps = dumps
+        self._cond = threading.Condition()
+        self._pending = []
+        self._committing = False
+
+    def submit(self, item):
+        slot = {"done": False}
+        with self._cond:
+            self._pending.append((item, slot))
+            while not slot["done"]:
+                if self._committing:
+                    self._cond.wait()
+                    continue
+                batch, self._pending = self._pending, []
+                self._committing = True
+                self._cond.release()
+                try:
+                    self._commit(batch)
+                finally:
+                    self._cond.acquire()
+                    self._committing = False
+                    self._cond.notify_all()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["result"]
+
+    def _commit(self, batch):
+        try:
+            results = update_json(
+                self.path,
+                lambda data: self._apply(data, [item for item, _ in batch]),
+                self._default,
+                self._loads,
+                self._dumps,
+            )
+        except Exception as e:
+            for _, slot in batch:
+                slot["error"] = e
+                slot["done"] = True
+            return
+        for (_, slot), result in zip(batch, results):
+            slot["result"] = result
+            slot["done"] = True
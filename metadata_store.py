@@ -0,0 +1,643 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import Counter
+
+import config
+from jsonstore import GroupCommitter, file_lock, read_json, update_json
+from models import CODECS
+
+
+class MetadataStore:
+    """Interface shared by the file metadata backends.
+
+    Records are plain dicts with the same keys that storage/files.json has
+    always used, plus an integer "id" assigned by the backend and the
+    "sha256" of the content blob (absent on records from before blobs).
+    """
+
+    def add_file(self, record):
+        """Store a new file record and return its id."""
+        raise NotImplementedError
+
+    def add_files(self, records):
+        """Store several new file records in one atomic write; returns their ids in order."""
+        raise NotImplementedError
+
+    def import_records(self, records):
+        """Bulk-insert existing records, returning how many were added."""
+        raise NotImplementedError
+
+    def files_for_issuer(self, issuer):
+        raise NotImplementedError
+
+    def files_for_custodian(self, custodian, issuers):
+        """Files shared with the custodian by any of the given issuers."""
+        raise NotImplementedError
+
+    def page_for_issuer(self, issuer, after=None, limit=50):
+        """One page of the issuer's files, newest first.
+
+        Pages are keyed on (upload_time, filename, id): ``after`` is the key
+        of the last record already shown. Returns (records, next_key), with
+        next_key None on the last page.
+        """
+        return page_records(self.files_for_issuer(issuer), after, limit)
+
+    def page_for_custodian(self, custodian, issuers, after=None, limit=50):
+        """Like page_for_issuer, over files_for_custodian()."""
+        return page_records(self.files_for_custodian(custodian, issuers), after, limit)
+
+    def find_files(self, filename):
+        raise NotImplementedError
+
+    def get_file(self, issuer, filename):
+        """The issuer's file with this logical name, or None."""
+        raise NotImplementedError
+
+    def get_file_by_id(self, file_id):
+        raise NotImplementedError
+
+    def files_by_ids(self, ids):
+        """Records for ``ids``, in the same order; unknown ids are skipped."""
+        records = (self.get_file_by_id(file_id) for file_id in ids)
+        return [r for r in records if r is not None]
+
+    def files_with_blob(self, sha256):
+        """Every record whose content is the blob ``sha256``."""
+        return [f for f in self.all_files() if f.get("sha256") == sha256]
+
+    def set_blob(self, file_id, sha256, size=None):
+        """Point an existing record at a content blob (of ``size`` bytes, if given)."""
+        raise NotImplementedError
+
+    def delete_file(self, file_id):
+        raise NotImplementedError
+
+    def blob_refcounts(self):
+        """Map of sha256 -> number of records referencing that blob."""
+        raise NotImplementedError
+
+    def all_files(self):
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def never_written(self):
+        """True if no record has ever been stored here (deleting them all does not count)."""
+        raise NotImplementedError
+
+    # True when generation() counts every change exactly, so a caller that
+    # sees it advance by one after its own write knows nothing else changed.
+    exact_generation = False
+
+    def generation(self):
+        """Token that changes whenever records are added, removed or re-shared."""
+        raise NotImplementedError
+
+    def change_cursor(self):
+        """Position in the change log to pass to changes_since(), or None if
+        the backend keeps no log (callers then rescan after every change).
+
+        Read it before scanning the records it will be applied to.
+        """
+        return None
+
+    def changes_since(self, cursor):
+        """(new cursor, ids of records added, removed or re-shared since ``cursor``).
+
+        Returns None when the log no longer reaches back that far.
+        """
+        return None
+
+    def access_entries(self):
+        """Yield (file_id, issuer, custodians) for every record, for acl.py."""
+        for f in self.all_files():
+            yield f["id"], f.get("issuer"), tuple(f.get("custodians", ()))
+
+    def search_entries(self):
+        """Yield (page key, issuer, custodians, mime_type) per record, for search_index.py."""
+        for f in self.all_files():
+            yield page_key(f), f.get("issuer"), tuple(f.get("custodians", ())), f.get("mime_type")
+
+
+def page_key(record):
+    """Sort key used for keyset pagination."""
+    return (record.get("upload_time") or "", record["filename"], record["id"])
+
+
+def page_records(records, after, limit):
+    """Keyset-paginate an in-memory list of records, newest first."""
+    if after is not None:
+        after = tuple(after)
+        records = [r for r in records if page_key(r) < after]
+    page = sorted(records, key=page_key, reverse=True)[:limit + 1]
+    if len(page) > limit:
+        return page[:limit], page_key(page[limit - 1])
+    return page, None
+
+
+class JSONMetadataStore(MetadataStore):
+    """The original storage/files.json layout, kept for small installs.
+
+    Writes go through jsonstore, so they are locked against other workers
+    and committed atomically; concurrent uploads share one commit. With
+    ``codec="msgpack"`` the same list of records is kept as MessagePack.
+
+    Reads decode the file once into validated FileRecord structs and reuse
+    them until the file's (mtime, size, inode) stamp changes; lookups filter
+    the structs and only convert matches to dicts.
+    """
+
+    def __init__(self, path, codec="json"):
+        self.path = path
+        self.codec = CODECS[codec]
+        self._appender = GroupCommitter(
+            path, self._append, default=[], loads=self.codec.loads, dumps=self.codec.dumps
+        )
+        self._cache_lock = threading.Lock()
+        self._records = []
+        self._stamp = None
+
+    @staticmethod
+    def _assign_ids(records):
+        # Legacy records have no id; their position is stable because the
+        # file is append-only.
+        for position, record in enumerate(records, start=1):
+            record.setdefault("id", position)
+        return records
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _load(self):
+        """All records as FileRecord structs (shared; do not mutate)."""
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return self._records
+        with self._cache_lock:
+            if stamp != self._stamp:
+                records = read_json(self.path, [], self.codec.files)
+                for position, record in enumerate(records, start=1):
+                    if not record.id:
+                        record.id = position
+                self._records, self._stamp = records, stamp
+            return self._records
+
+    def _update(self, mutate):
+        return update_json(self.path, mutate, [], self.codec.loads, self.codec.dumps)
+
+    def _append(self, existing, records):
+        self._assign_ids(existing)
+        next_id = max((r["id"] for r in existing), default=0) + 1
+        ids = []
+        for offset, record in enumerate(records):
+            existing.append(dict(record, id=next_id + offset))
+            ids.append(next_id + offset)
+        return ids
+
+    def add_file(self, record):
+        return self._appender.submit(record)
+
+    def add_files(self, records):
+        if not records:
+            return []
+        return self._update(lambda data: self._append(data, records))
+
+    def import_records(self, records):
+        return len(self._update(lambda data: self._append(data, records)))
+
+    def files_for_issuer(self, issuer):
+        return [f.to_dict() for f in self._load() if f.issuer == issuer]
+
+    def files_for_custodian(self, custodian, issuers):
+        issuers = set(issuers)
+        return [
+            f.to_dict() for f in self._load()
+            if f.issuer in issuers and custodian in f.custodians
+        ]
+
+    def find_files(self, filename):
+        return [f.to_dict() for f in self._load() if f.filename == filename]
+
+    def get_file(self, issuer, filename):
+        for f in self._load():
+            if f.issuer == issuer and f.filename == filename:
+                return f.to_dict()
+        return None
+
+    def get_file_by_id(self, file_id):
+        for f in self._load():
+            if f.id == file_id:
+                return f.to_dict()
+        return None
+
+    def files_with_blob(self, sha256):
+        return [f.to_dict() for f in self._load() if f.sha256 == sha256]
+
+    def files_by_ids(self, ids):
+        wanted = set(ids)
+        found = {f.id: f for f in self._load() if f.id in wanted}
+        return [found[i].to_dict() for i in ids if i in found]
+
+    def _update_record(self, file_id, change):
+        def mutate(records):
+            self._assign_ids(records)
+            for index, record in enumerate(records):
+                if record["id"] == file_id:
+                    change(records, index)
+                    return True
+            return False
+        return self._update(mutate)
+
+    def set_blob(self, file_id, sha256, size=None):
+        change = {"sha256": sha256} if size is None else {"sha256": sha256, "size": size}
+        self._update_record(file_id, lambda records, i: records[i].update(change))
+
+    def delete_file(self, file_id):
+        self._update_record(file_id, lambda records, i: records.pop(i))
+
+    def blob_refcounts(self):
+        return Counter(f.sha256 for f in self._load() if f.sha256)
+
+    def all_files(self):
+        return [f.to_dict() for f in self._load()]
+
+    def count(self):
+        return len(self._load())
+
+    def never_written(self):
+        return not os.path.exists(self.path)
+
+    def generation(self):
+        # Other workers may write several times between our reads, so the
+        # file stamp is only a change marker, not a count.
+        self._load()
+        return self._stamp
+
+    def access_entries(self):
+        for f in self._load():
+            yield f.id, f.issuer, tuple(f.custodians)
+
+    def search_entries(self):
+        for f in self._load():
+            yield (f.upload_time or "", f.filename, f.id), f.issuer, tuple(f.custodians), f.mime_type
+
+
+class SQLiteMetadataStore(MetadataStore):
+    """Embedded SQLite backend with indexes for the dashboard lookups."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER,
+            upload_time TEXT NOT NULL,
+            mime_type TEXT,
+            issuer TEXT,
+            custodians TEXT NOT NULL DEFAULT '[]',
+            sha256 TEXT
+        );
+        CREATE TABLE IF NOT EXISTS file_custodians (
+            custodian TEXT NOT NULL,
+            file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+            PRIMARY KEY (custodian, file_id)
+        ) WITHOUT ROWID;
+        -- Lets ON DELETE CASCADE find a file's rows without a full scan.
+        CREATE INDEX IF NOT EXISTS file_custodians_file ON file_custodians(file_id);
+        CREATE INDEX IF NOT EXISTS files_issuer ON files(issuer, upload_time);
+        CREATE INDEX IF NOT EXISTS files_filename ON files(filename);
+        CREATE INDEX IF NOT EXISTS files_upload_time ON files(upload_time);
+        CREATE INDEX IF NOT EXISTS files_issuer_filename ON files(issuer, filename);
+        CREATE INDEX IF NOT EXISTS files_issuer_page ON files(issuer, upload_time, filename, id);
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            refcount INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        INSERT OR IGNORE INTO counters (name, value) VALUES ('generation', 0);
+        CREATE TRIGGER IF NOT EXISTS files_generation_insert AFTER INSERT ON files BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'generation';
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_generation_delete AFTER DELETE ON files BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'generation';
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_generation_update AFTER UPDATE OF issuer, custodians ON files BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'generation';
+        END;
+        -- Which rows those changes touched, so other workers can patch
+        -- their indexes instead of rescanning. Only the newest rows are kept.
+        CREATE TABLE IF NOT EXISTS file_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS files_changes_insert AFTER INSERT ON files BEGIN
+            INSERT INTO file_changes (file_id) VALUES (new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_changes_delete AFTER DELETE ON files BEGIN
+            INSERT INTO file_changes (file_id) VALUES (old.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_changes_update AFTER UPDATE OF issuer, custodians ON files BEGIN
+            INSERT INTO file_changes (file_id) VALUES (new.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_changes_prune AFTER INSERT ON file_changes BEGIN
+            DELETE FROM file_changes WHERE seq <= new.seq - 100000;
+        END;
+    """
+
+    # Columns added after the first release, applied to existing databases.
+    MIGRATIONS = {
+        "sha256": "ALTER TABLE files ADD COLUMN sha256 TEXT",
+    }
+
+    COLUMNS = ("id", "filename", "size", "upload_time", "mime_type", "issuer", "custodians", "sha256")
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+            for column, statement in self.MIGRATIONS.items():
+                if existing and column not in existing:
+                    conn.execute(statement)
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads, so each
+        # worker thread keeps its own. Nor may they cross a fork: a worker
+        # forked from a preloaded master opens fresh ones and leaves the
+        # inherited handle alone.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _to_record(self, row):
+        record = dict(row)
+        record["custodians"] = json.loads(record["custodians"])
+        if record["sha256"] is None:
+            del record["sha256"]
+        return record
+
+    def _add_ref(self, conn, sha256, delta):
+        if sha256:
+            conn.execute(
+                "INSERT INTO blobs (sha256, refcount) VALUES (?, ?)"
+                " ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + excluded.refcount",
+                (sha256, delta),
+            )
+
+    def _select(self, sql, params=()):
+        columns = ", ".join("f." + c for c in self.COLUMNS)
+        rows = self._connect().execute(sql.format(columns=columns), params)
+        return [self._to_record(row) for row in rows]
+
+    def _insert(self, conn, record):
+        custodians = list(record.get("custodians", []))
+        cursor = conn.execute(
+            "INSERT INTO files (filename, size, upload_time, mime_type, issuer, custodians, sha256)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                record["filename"],
+                record.get("size"),
+                record["upload_time"],
+                record.get("mime_type"),
+                record.get("issuer"),
+                json.dumps(custodians),
+                record.get("sha256"),
+            ),
+        )
+        file_id = cursor.lastrowid
+        self._add_ref(conn, record.get("sha256"), 1)
+        conn.executemany(
+            "INSERT OR IGNORE INTO file_custodians (custodian, file_id) VALUES (?, ?)",
+            [(c, file_id) for c in custodians],
+        )
+        return file_id
+
+    def add_file(self, record):
+        with self._connect() as conn:
+            return self._insert(conn, record)
+
+    def add_files(self, records):
+        with self._connect() as conn:
+            return [self._insert(conn, record) for record in records]
+
+    def import_records(self, records):
+        with self._connect() as conn:
+            for record in records:
+                self._insert(conn, record)
+        return len(records)
+
+    def files_for_issuer(self, issuer):
+        return self._select(
+            "SELECT {columns} FROM files f WHERE f.issuer = ? ORDER BY f.id", (issuer,)
+        )
+
+    def files_for_custodian(self, custodian, issuers):
+        issuers = list(issuers)
+        if not issuers:
+            return []
+        placeholders = ", ".join("?" * len(issuers))
+        return self._select(
+            "SELECT {columns} FROM file_custodians fc JOIN files f ON f.id = fc.file_id"
+            " WHERE fc.custodian = ? AND f.issuer IN (" + placeholders + ") ORDER BY f.id",
+            [custodian] + issuers,
+        )
+
+    def _page(self, sql, params, after, limit):
+        # Row-value comparison lets SQLite seek straight to the page start.
+        if after is not None:
+            sql += " AND (f.upload_time, f.filename, f.id) < (?, ?, ?)"
+            params = list(params) + list(after)
+        sql += " ORDER BY f.upload_time DESC, f.filename DESC, f.id DESC LIMIT ?"
+        page = self._select(sql, list(params) + [limit + 1])
+        if len(page) > limit:
+            return page[:limit], page_key(page[limit - 1])
+        return page, None
+
+    def page_for_issuer(self, issuer, after=None, limit=50):
+        return self._page("SELECT {columns} FROM files f WHERE f.issuer = ?", [issuer], after, limit)
+
+    def page_for_custodian(self, custodian, issuers, after=None, limit=50):
+        issuers = list(issuers)
+        if not issuers:
+            return [], None
+        placeholders = ", ".join("?" * len(issuers))
+        return self._page(
+            "SELECT {columns} FROM file_custodians fc JOIN files f ON f.id = fc.file_id"
+            " WHERE fc.custodian = ? AND f.issuer IN (" + placeholders + ")",
+            [custodian] + issuers,
+            after,
+            limit,
+        )
+
+    def find_files(self, filename):
+        return self._select(
+            "SELECT {columns} FROM files f WHERE f.filename = ? ORDER BY f.id", (filename,)
+        )
+
+    def get_file(self, issuer, filename):
+        rows = self._select(
+            "SELECT {columns} FROM files f WHERE f.issuer = ? AND f.filename = ? LIMIT 1",
+            (issuer, filename),
+        )
+        return rows[0] if rows else None
+
+    def get_file_by_id(self, file_id):
+        rows = self._select("SELECT {columns} FROM files f WHERE f.id = ?", (file_id,))
+        return rows[0] if rows else None
+
+    def files_with_blob(self, sha256):
+        return self._select("SELECT {columns} FROM files f WHERE f.sha256 = ? ORDER BY f.id", (sha256,))
+
+    def files_by_ids(self, ids):
+        ids = list(ids)
+        found = {}
+        # Stay well under SQLite's bound-parameter limit.
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for record in self._select("SELECT {columns} FROM files f WHERE f.id IN (" + placeholders + ")", chunk):
+                found[record["id"]] = record
+        return [found[i] for i in ids if i in found]
+
+    def _blob_of(self, conn, file_id):
+        row = conn.execute("SELECT sha256 FROM files WHERE id = ?", (file_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_blob(self, file_id, sha256, size=None):
+        with self._connect() as conn:
+            self._add_ref(conn, self._blob_of(conn, file_id), -1)
+            conn.execute(
+                "UPDATE files SET sha256 = ?, size = COALESCE(?, size) WHERE id = ?", (sha256, size, file_id)
+            )
+            self._add_ref(conn, sha256, 1)
+
+    def delete_file(self, file_id):
+        with self._connect() as conn:
+            self._add_ref(conn, self._blob_of(conn, file_id), -1)
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def blob_refcounts(self):
+        rows = self._connect().execute("SELECT sha256, refcount FROM blobs")
+        return {sha256: refcount for sha256, refcount in rows}
+
+    def all_files(self):
+        return self._select("SELECT {columns} FROM files f ORDER BY f.id")
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def never_written(self):
+        return self.generation() == 0
+
+    # Maintained by triggers: one step per inserted, deleted or re-shared row.
+    exact_generation = True
+
+    def generation(self):
+        return self._connect().execute(
+            "SELECT value FROM counters WHERE name = 'generation'"
+        ).fetchone()[0]
+
+    def change_cursor(self):
+        return self._connect().execute("SELECT COALESCE(MAX(seq), 0) FROM file_changes").fetchone()[0]
+
+    def changes_since(self, cursor):
+        rows = self._connect().execute(
+            "SELECT seq, file_id FROM file_changes WHERE seq > ? ORDER BY seq", (cursor,)
+        ).fetchall()
+        if not rows:
+            return cursor, set()
+        # AUTOINCREMENT never reuses or skips a committed seq, so a gap
+        # after the cursor means the rows were pruned.
+        if rows[0][0] != cursor + 1:
+            return None
+        return rows[-1][0], {file_id for _, file_id in rows}
+
+    def access_entries(self):
+        # One pass over files: the custodians column holds the same names
+        # as file_custodians, which is only indexed by custodian.
+        rows = self._connect().execute("SELECT id, issuer, custodians FROM files")
+        for file_id, issuer, custodians in rows:
+            yield file_id, issuer, tuple(json.loads(custodians))
+
+
+BACKENDS = {
+    "json": lambda: JSONMetadataStore(config.FILES_JSON_PATH),
+    "msgpack": lambda: JSONMetadataStore(config.FILES_MSGPACK_PATH, codec="msgpack"),
+    "sqlite": lambda: SQLiteMetadataStore(config.METADATA_DB_PATH),
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide metadata store selected by config.METADATA_BACKEND.
+
+    A new SQLite or MessagePack store is first filled from an existing
+    storage/files.json, so upgrading keeps every record.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = BACKENDS[config.METADATA_BACKEND]()
+                if config.METADATA_BACKEND != "json" and os.path.exists(config.FILES_JSON_PATH):
+                    import_legacy(config.FILES_JSON_PATH, store)
+                _store = store
+    return _store
+
+
+def migrate_json(json_path, store):
+    """Import every record from a legacy files.json into the given store."""
+    with open(json_path, "r") as f:
+        records = json.load(f)
+    records = [{k: v for k, v in r.items() if k != "id"} for r in records]
+    return store.import_records(records)
+
+
+def import_legacy(json_path, store):
+    """migrate_json() into a store nothing has been written to yet, else None.
+
+    Locked, so workers opening a new store at once import it only once.
+    """
+    with file_lock(store.path + ".import"):
+        if not store.never_written():
+            return None
+        return migrate_json(json_path, store)
+
+
+if __name__ == "__main__":
+    # One-shot migration: python metadata_store.py [storage/files.json]
+    # (get_store() already does this for the default path on first open.)
+    source = sys.argv[1] if len(sys.argv) > 1 else config.FILES_JSON_PATH
+    if config.METADATA_BACKEND == "json":
+        sys.exit("METADATA_BACKEND is 'json'; nothing to migrate.")
+    target = BACKENDS[config.METADATA_BACKEND]()
+    with file_lock(target.path + ".import"):
+        if target.count():
+            sys.exit(f"{target.path} already has records; refusing to import twice.")
+        imported = migrate_json(source, target)
+    print(f"Imported {imported} records from {source} into {target.path}")
@@ -0,0 +1,277 @@
+import bisect
+import cProfile
+import heapq
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+import config
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = tuple(4 ** i for i in range(5, 16))  # 1 KiB .. 1 GiB
+THROUGHPUT_BUCKETS = tuple(2 ** i for i in range(16, 34, 2))  # 64 KiB/s .. 4 GiB/s
+
+# Endpoints whose bodies are file content, for the throughput metrics.
+UPLOAD_ENDPOINTS = {
+    "file_upload.upload_file",
+    "file_upload.upload_batch",
+    "dashboard.dashboard",
+    "chunked_upload.upload_chunk",
+}
+DOWNLOAD_ENDPOINTS = {
+    "file_upload.download_file",
+    "custodian.export_files",
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket (non-cumulative) counts, then sum and count.
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, [list(s[0]), s[1], s[2]]) for labels, s in self._series.items())
+        names = self.labels + ("le",)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "sdira_request_duration_seconds", "Time from request start until the response body was sent.",
+    LATENCY_BUCKETS, ("endpoint", "method", "status"),
+)
+REQUEST_BYTES = Histogram(
+    "sdira_request_size_bytes", "Request body size.", SIZE_BUCKETS, ("endpoint",),
+)
+RESPONSE_BYTES = Histogram(
+    "sdira_response_size_bytes", "Response body size.", SIZE_BUCKETS, ("endpoint",),
+)
+TRANSFER_BYTES = Counter(
+    "sdira_transfer_bytes_total", "File content bytes received or sent.", ("direction", "endpoint"),
+)
+TRANSFER_THROUGHPUT = Histogram(
+    "sdira_transfer_throughput_bytes_per_second", "Per-request upload/download throughput.",
+    THROUGHPUT_BUCKETS, ("direction", "endpoint"),
+)
+SPAN_SECONDS = Histogram(
+    "sdira_span_duration_seconds", "Time spent in instrumented hot-path calls.",
+    LATENCY_BUCKETS, ("span",),
+)
+RENDER_CACHE = Counter(
+    "sdira_render_cache_total", "Dashboard file lists served: not_modified (304), hit or miss.",
+    ("view", "outcome"),
+)
+
+REGISTRY = [
+    REQUEST_SECONDS, REQUEST_BYTES, RESPONSE_BYTES, TRANSFER_BYTES, TRANSFER_THROUGHPUT, SPAN_SECONDS,
+    RENDER_CACHE,
+]
+
+
+@contextmanager
+def span(name):
+    """Time a block into sdira_span_duration_seconds{span=name}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SPAN_SECONDS.observe(time.perf_counter() - start, name)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+class SlowestProfiles:
+    """Keeps cProfile dumps of the ``keep`` slowest sampled requests on disk."""
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+        self._heap = []  # (duration, path), fastest first
+        self._lock = threading.Lock()
+
+    def offer(self, profile, duration, endpoint):
+        with self._lock:
+            if len(self._heap) >= self.keep and duration <= self._heap[0][0]:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory, f"{duration * 1000:09.1f}ms-{endpoint}-{uuid.uuid4().hex[:8]}.prof"
+            )
+            profile.dump_stats(path)
+            if len(self._heap) >= self.keep:
+                _, evicted = heapq.heapreplace(self._heap, (duration, path))
+                try:
+                    os.unlink(evicted)
+                except FileNotFoundError:
+                    pass
+            else:
+                heapq.heappush(self._heap, (duration, path))
+
+
+def _body_size(response):
+    if response.content_length is not None:
+        return response.content_length
+    if not response.is_streamed:
+        return len(response.get_data())
+    return 0
+
+
+class _MeteredBody:
+    """Response body wrapper that counts bytes and reports when it is closed.
+
+    Responses with direct_passthrough skip Response.call_on_close, so the
+    hook has to travel with the body itself.
+    """
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self._body, "close", None)
+            if close is not None:
+                close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close(self.sent)
+
+
+def init_app(app):
+    """Install request timing, size and profiling hooks plus GET /metrics."""
+    profiles = None
+    if config.METRICS_PROFILE_RATE > 0:
+        profiles = SlowestProfiles(config.METRICS_PROFILE_DIR, config.METRICS_PROFILE_KEEP)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        g.metrics_profile = None
+        if profiles is not None and random.random() < config.METRICS_PROFILE_RATE:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except RuntimeError:
+                # Another profiler (e.g. a still-streaming response) is active.
+                return
+            g.metrics_profile = profile
+
+    @app.after_request
+    def record(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        profile = g.pop("metrics_profile", None)
+        endpoint = request.endpoint or "unmatched"
+        method = request.method
+        status = response.status_code
+        received = request.content_length or 0
+
+        def finish(sent):
+            duration = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                profiles.offer(profile, duration, endpoint)
+            REQUEST_SECONDS.observe(duration, endpoint, method, str(status))
+            REQUEST_BYTES.observe(received, endpoint)
+            RESPONSE_BYTES.observe(sent, endpoint)
+            for direction, endpoints, size in (
+                ("upload", UPLOAD_ENDPOINTS, received),
+                ("download", DOWNLOAD_ENDPOINTS, sent),
+            ):
+                if endpoint in endpoints and size:
+                    TRANSFER_BYTES.inc(direction, endpoint, amount=size)
+                    TRANSFER_THROUGHPUT.observe(size / max(duration, 1e-6), direction, endpoint)
+
+        has_body = method != "HEAD" and status >= 200 and status not in (204, 304)
+        if has_body and response.is_streamed and not hasattr(response.response, "filelike"):
+            # Generated bodies (ranges, ZIP exports) are timed to their last byte.
+            response.response = _MeteredBody(response.response, finish)
+        else:
+            # Buffered bodies are complete here; whole files are handed to the
+            # server's file_wrapper (sendfile), which must not be wrapped.
+            finish(_body_size(response))
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
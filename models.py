@@ -0,0 +1,143 @@
+import sys
+
+import msgspec
+
+
+class FileRecord(msgspec.Struct, gc=False):
+    """Typed in-memory form of one files.json record.
+
+    Structs store fields in slots instead of a per-record dict, and
+    issuer/custodian names are interned so a catalog holds one copy of
+    each. gc=False is safe because records never reference each other.
+    """
+
+    filename: str
+    upload_time: str
+    issuer: str | None = None
+    custodians: list[str] = []
+    size: int | None = None
+    mime_type: str | None = None
+    sha256: str | None = None
+    id: int = 0
+
+    def __post_init__(self):
+        if self.issuer is not None:
+            self.issuer = sys.intern(self.issuer)
+        self.custodians = [sys.intern(c) for c in self.custodians]
+
+    def to_dict(self):
+        """The plain-dict record shape the metadata store hands out."""
+        record = msgspec.structs.asdict(self)
+        if record["sha256"] is None:
+            del record["sha256"]
+        return record
+
+
+class UserRecord(msgspec.Struct, gc=False):
+    """Typed in-memory form of one users.json entry."""
+
+    password: str
+    role: str | None = None
+    manages: list[str] = []
+
+    def __post_init__(self):
+        if self.role is not None:
+            self.role = sys.intern(self.role)
+        self.manages = [sys.intern(m) for m in self.manages]
+
+
+class Codec:
+    """Encodes a store file and decodes it either raw or into typed records.
+
+    ``loads``/``dumps`` work on plain Python data for read-modify-write;
+    ``files``/``users`` decode straight into validated records, raising
+    ValueError for data that does not match the schema.
+    """
+
+    def __init__(self, name, module, dumps):
+        self.name = name
+        self._module = module
+        self._dumps = dumps
+        self._files = module.Decoder(list[FileRecord])
+        self._users = module.Decoder(dict[str, UserRecord])
+
+    def _decode(self, decoder, data):
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def loads(self, data):
+        try:
+            return self._module.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def dumps(self, data):
+        return self._dumps(data)
+
+    def files(self, data):
+        return self._decode(self._files, data)
+
+    def users(self, data):
+        return self._decode(self._users, data)
+
+
+CODECS = {
+    # Indented like the files json.dump always wrote, so diffs stay readable.
+    "json": Codec("json", msgspec.json, lambda data: msgspec.json.format(msgspec.json.encode(data), indent=4)),
+    "msgpack": Codec("msgpack", msgspec.msgpack, msgspec.msgpack.encode),
+}
+
+
+class FileSummary(msgspec.Struct, omit_defaults=True):
+    """A file record as returned by the JSON API."""
+
+    id: int
+    filename: str
+    upload_time: str = ""
+    size: int | None = None
+    mime_type: str | None = None
+    issuer: str | None = None
+    custodians: list[str] = []
+    sha256: str | None = None
+
+
+class FilePage(msgspec.Struct):
+    """One page of a file listing; pass next_cursor back as ?cursor= for the next."""
+
+    files: list[FileSummary]
+    next_cursor: str | None = None
+
+
+class ContentHit(msgspec.Struct):
+    """A spreadsheet row matching a content search; ``row`` is a preview offset."""
+
+    file: FileSummary
+    sheet: str
+    sheet_index: int
+    row: int
+
+
+class ContentHits(msgspec.Struct):
+    hits: list[ContentHit]
+    truncated: bool = False
+
+
+json_encoder = msgspec.json.Encoder()
+
+
+def file_page(records, next_cursor=None):
+    """Build a FilePage from store records (plain dicts), validating them."""
+    return FilePage(msgspec.convert(records, list[FileSummary]), next_cursor)
+
+
+def content_hits(found, truncated=False):
+    """Build ContentHits from ContentIndex.search() results."""
+    return ContentHits(
+        [
+            ContentHit(msgspec.convert(record, FileSummary), sheet, sheet_index, row)
+            for record, sheet, sheet_index, row in found
+        ],
+        truncated,
+    )
@@ -0,0 +1,35 @@
+import base64
+
+import msgspec
+
+import config
+
+_cursor_decoder = msgspec.json.Decoder(tuple[str, str, int])
+
+
+def encode_cursor(key):
+    """Opaque URL-safe token for a (upload_time, filename, id) page key."""
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(msgspec.json.encode(key)).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; None for an empty token, ValueError if malformed."""
+    if not token:
+        return None
+    try:
+        return _cursor_decoder.decode(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, msgspec.DecodeError):
+        raise ValueError("Invalid cursor") from None
+
+
+def page_params(args):
+    """(after, limit) from ?cursor= and ?limit= query arguments.
+
+    The limit defaults to FILES_PAGE_SIZE and is clamped to
+    [1, MAX_FILES_PAGE_SIZE]. Raises ValueError for a bad cursor.
+    """
+    after = decode_cursor(args.get("cursor", ""))
+    limit = args.get("limit", config.FILES_PAGE_SIZE, type=int)
+    return after, max(1, min(limit, config.MAX_FILES_PAGE_SIZE))
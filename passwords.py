@@ -0,0 +1,161 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import config
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many password hashes are already queued or running."""
+
+
+def hash_method(pwhash):
+    """The method part of a werkzeug hash, e.g. "scrypt:32768:8:1"."""
+    return pwhash.split("$", 1)[0]
+
+
+class PasswordHasher:
+    """Runs password KDFs on a small dedicated thread pool.
+
+    hashlib's scrypt and pbkdf2 release the GIL, so a thread pool keeps
+    request workers free while capping how many ~32 MB scrypt computations
+    run at once (``workers``). At most ``queue_limit`` more wait behind
+    them; beyond that callers get PasswordPoolBusy straight away instead of
+    piling up.
+
+    Failed (username, password) pairs are remembered for ``failure_ttl``
+    seconds as keyed digests, so retrying the same wrong password is
+    rejected without running the KDF again. The cache entry is tied to the
+    stored hash, so a password change invalidates it.
+    """
+
+    def __init__(self, workers, queue_limit, target_method, failure_ttl, max_failures_per_user=8):
+        self.target_method = target_method
+        self.failure_ttl = failure_ttl
+        self.max_failures_per_user = max_failures_per_user
+        self._workers = workers
+        self._queue_limit = queue_limit
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._key = os.urandom(32)
+        self._failures = {}
+        self._failures_lock = threading.Lock()
+
+    def _executor(self):
+        # Threads do not survive fork, so a worker forked from a preloaded
+        # master starts its own pool (and slot count).
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="password")
+                self._slots = threading.BoundedSemaphore(self._workers + self._queue_limit)
+                self._pool_pid = os.getpid()
+            return self._pool, self._slots
+
+    def _submit(self, fn, *args):
+        pool, slots = self._executor()
+        if not slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+        try:
+            future = pool.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def _fingerprint(self, username, pwhash, password):
+        message = "\0".join((username, pwhash, password)).encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def _known_failure(self, username, fingerprint):
+        now = time.monotonic()
+        with self._failures_lock:
+            entries = self._failures.get(username)
+            if not entries:
+                return False
+            for fp, expires in list(entries.items()):
+                if expires <= now:
+                    del entries[fp]
+            if not entries:
+                del self._failures[username]
+            return fingerprint in entries
+
+    def _remember_failure(self, username, fingerprint):
+        with self._failures_lock:
+            entries = self._failures.setdefault(username, {})
+            if len(entries) >= self.max_failures_per_user:
+                entries.pop(next(iter(entries)))
+            entries[fingerprint] = time.monotonic() + self.failure_ttl
+
+    def verify(self, username, pwhash, password, timeout=None):
+        """Check ``password`` against ``pwhash`` on the pool.
+
+        Raises PasswordPoolBusy when the pool is saturated.
+        """
+        fingerprint = self._fingerprint(username, pwhash, password)
+        if self._known_failure(username, fingerprint):
+            return False
+        ok = self._submit(check_password_hash, pwhash, password).result(timeout)
+        if ok:
+            with self._failures_lock:
+                self._failures.pop(username, None)
+        else:
+            self._remember_failure(username, fingerprint)
+        return ok
+
+    def hash(self, password, timeout=None):
+        """generate_password_hash with the target method, run on the pool."""
+        return self._submit(generate_password_hash, password, self.target_method).result(timeout)
+
+    def needs_rehash(self, pwhash):
+        return hash_method(pwhash) != self.target_method
+
+    def upgrade(self, directory, username, old_hash, password):
+        """Rehash a just-verified password to the target method in the background.
+
+        The new hash is only written if the stored one is still ``old_hash``.
+        Skipped silently when the pool is busy; the next login will retry.
+        """
+        def store(future):
+            if future.exception() is not None:
+                return
+            new_hash = future.result()
+
+            def replace(users):
+                user = users.get(username)
+                if not user or user.get("password") != old_hash:
+                    return False
+                user["password"] = new_hash
+                return True
+
+            directory.update(replace)
+
+        try:
+            self._submit(generate_password_hash, password, self.target_method).add_done_callback(store)
+        except PasswordPoolBusy:
+            pass
+
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher():
+    """Return the process-wide PasswordHasher."""
+    global _hasher
+    if _hasher is None:
+        with _hasher_lock:
+            if _hasher is None:
+                _hasher = PasswordHasher(
+                    config.PASSWORD_WORKERS,
+                    config.PASSWORD_QUEUE_LIMIT,
+                    config.PASSWORD_HASH_METHOD,
+                    config.PASSWORD_FAILURE_TTL,
+                )
+    return _hasher
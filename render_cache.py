@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from flask import Response, request, session
+from markupsafe import Markup
+
+import config
+from jsonstore import file_lock, read_json
+from metrics import RENDER_CACHE
+
+
+class CatalogGeneration:
+    """Cross-process counter bumped by every change a dashboard can show.
+
+    Uploads, new versions, issuer/custodian links and job status changes
+    bump it. The number lives in a small file; readers stat it and only
+    re-read it when its (mtime, size, inode) stamp moves, so checking is a
+    single stat() call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._value = 0
+
+    def current(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp != self._stamp:
+            with self._lock:
+                self._value, self._stamp = read_json(self.path, 0), stamp
+        return self._value
+
+    def bump(self):
+        # Caches only live as long as their process, so unlike the stores
+        # this is not fsynced: after a crash there is nothing stale to serve.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with file_lock(self.path):
+            value = read_json(self.path, 0) + 1
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".generation-")
+            with os.fdopen(fd, "w") as f:
+                f.write(str(value))
+            os.replace(tmp, self.path)
+        return value
+
+
+class RenderCache:
+    """LRU of rendered HTML fragments holding at most ``max_bytes``.
+
+    Each entry remembers the catalog generation it was rendered at and is
+    only served while that generation is current.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, generation, html):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= sys.getsizeof(old[1])
+            self._entries[key] = (generation, html)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= sys.getsizeof(evicted)
+
+
+_generation = None
+_cache = None
+_init_lock = threading.Lock()
+
+
+def get_catalog_generation():
+    """Return the process-wide CatalogGeneration."""
+    global _generation
+    if _generation is None:
+        with _init_lock:
+            if _generation is None:
+                _generation = CatalogGeneration(config.CATALOG_GENERATION_PATH)
+    return _generation
+
+
+def get_render_cache():
+    """Return this process's RenderCache."""
+    global _cache
+    if _cache is None:
+        with _init_lock:
+            if _cache is None:
+                _cache = RenderCache(config.RENDER_CACHE_MAX_BYTES)
+    return _cache
+
+
+def bump_generation():
+    """Invalidate every cached dashboard fragment and ETag, in all processes."""
+    return get_catalog_generation().bump()
+
+
+def revalidate(view, page):
+    """Start serving a dashboard page identified by ``page`` (user, cursor, limit).
+
+    Returns (generation, etag, response). ``response`` is a 304 when the
+    browser's copy is still current, before anything is loaded or
+    rendered. ``etag`` is None when the page will show flashed messages,
+    which are one-off and must not be revalidated later.
+    """
+    generation = get_catalog_generation().current()
+    if "_flashes" in session:
+        return generation, None, None
+    digest = hashlib.sha1(repr((view,) + page).encode()).hexdigest()[:16]
+    etag = f"{generation}-{digest}"
+    if request.if_none_match.contains_weak(etag):
+        RENDER_CACHE.inc(view, "not_modified")
+        response = Response(status=304)
+        return generation, etag, finish(response, etag)
+    return generation, etag, None
+
+
+def fragment(view, page, generation, render):
+    """The cached HTML for ``page`` at ``generation``, calling render() on a miss."""
+    cache = get_render_cache()
+    key = (view,) + page
+    html = cache.get(key, generation)
+    if html is None:
+        RENDER_CACHE.inc(view, "miss")
+        html = render()
+        cache.put(key, generation, html)
+    else:
+        RENDER_CACHE.inc(view, "hit")
+    return Markup(html)
+
+
+def finish(response, etag):
+    """Mark a dashboard response as private and revalidated on every load."""
+    response.headers["Cache-Control"] = "private, no-cache"
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
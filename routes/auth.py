@@ -1,19 +1,9 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import check_password_hash, generate_password_hash
-import json
-import os
-
-USER_FILE = "storage/users.json"
-
-def load_users():
-    if not os.path.exists(USER_FILE):
-        return {}
-    with open(USER_FILE, "r") as f:
-        return json.load(f)
-
-def save_users(users):
-    with open(USER_FILE, "w") as f:
-        json.dump(users, f, indent=4)
+from acl import link_users
+from metrics import span
+from passwords import PasswordPoolBusy, get_hasher
+from render_cache import bump_generation
+from user_directory import get_directory
 
 auth_blueprint = Blueprint('auth', __name__)
 
@@ -22,16 +12,27 @@ def login():
     if request.method == 'POST':
         username = request.form['username'].strip()
         password = request.form['password'].strip()
-        users = load_users()
+        directory = get_directory()
+        with span("users.load"):
+            user_data = directory.snapshot().get(username)
+        hasher = get_hasher()
 
-        if username in users and check_password_hash(users[username]["password"], password):
-            user_data = users[username]
+        try:
+            with span("password.verify"):
+                valid = user_data is not None and hasher.verify(username, user_data.password, password)
+        except PasswordPoolBusy:
+            flash("The server is busy. Please try again in a moment.", "warning")
+            return render_template('login.html'), 503, {"Retry-After": "1"}
+
+        if valid:
+            if hasher.needs_rehash(user_data.password):
+                hasher.upgrade(directory, username, user_data.password, password)
             session['user'] = username
-            session['role'] = user_data.get("role")  # Store role in session
+            session['role'] = user_data.role  # Store role in session
             flash("Login successful!", "success")
 
             # Redirect based on role
-            if user_data.get("role") == "custodian":
+            if user_data.role == "custodian":
                 return redirect(url_for("custodian.custodian_dashboard"))
             else:  # issuer or default
                 return redirect(url_for("dashboard.dashboard"))
@@ -49,27 +50,50 @@ def register():
         role = request.form['role']
         manages = request.form.get('manages', "").strip()
         
-        users = load_users()
+        users = get_directory().snapshot()
 
-        if username in users:
+        if users.get(username):
             flash('Username already exists. Choose a different one.', 'danger')
         elif password != confirm_password:
             flash('Passwords do not match.', 'danger')
         elif len(password) < 6:
             flash('Password must be at least 6 characters long.', 'danger')
         else:
+            try:
+                with span("password.hash"):
+                    pwhash = get_hasher().hash(password)
+            except PasswordPoolBusy:
+                flash("The server is busy. Please try again in a moment.", "warning")
+                return render_template('register.html'), 503, {"Retry-After": "1"}
             user_data = {
-                "password": generate_password_hash(password),
+                "password": pwhash,
                 "role": role
             }
             if role == "custodian" and manages:
                 user_data["manages"] = [m.strip() for m in manages.split(",") if m.strip()]
 
-            users[username] = user_data
-            save_users(users)
+            def add_user(users):
+                # Re-check under the lock: another worker may have taken
+                # the name since we read the file above.
+                if username in users:
+                    return False
+                users[username] = user_data
+                # Mirror the links on the issuers' side
+                linked = False
+                for issuer in user_data.get("manages", []):
+                    if issuer in users and link_users(users, issuer, username):
+                        linked = True
+                return "linked" if linked else True
 
-            flash('Registration successful! You can now log in.', 'success')
-            return redirect(url_for('auth.login'))
+            with span("users.save"):
+                added = get_directory().update(add_user)
+            if added == "linked":
+                # The issuers' dashboards now list a new custodian
+                bump_generation()
+            if added:
+                flash('Registration successful! You can now log in.', 'success')
+                return redirect(url_for('auth.login'))
+            flash('Username already exists. Choose a different one.', 'danger')
 
     return render_template('register.html')
 
@@ -0,0 +1,265 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from flask import Blueprint, request, jsonify, session
+from werkzeug.utils import secure_filename
+
+import blobstore
+import config
+from acl import get_acl
+from jobs import get_queue
+from jsonstore import atomic_write_json, file_lock, read_json
+from metrics import span
+from metadata_store import get_store
+from render_cache import bump_generation
+from search_index import get_search_index
+from utils import allowed_file, build_file_metadata
+from versions import add_version
+
+chunked_upload = Blueprint("chunked_upload", __name__)
+
+READ_BLOCK_SIZE = 64 * 1024
+
+# upload_id -> (committed offset, sha256 of bytes[0:offset], last use).
+# hashlib state cannot be persisted, so a worker that did not see the
+# earlier chunks rebuilds it from the spooled file (see _hasher_at). Entries
+# idle for PARTIAL_UPLOAD_TTL (uploads abandoned, or finalized by another
+# worker) are dropped.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+def _state_path(upload_id):
+    return os.path.join(config.PARTIAL_UPLOAD_FOLDER, upload_id + ".json")
+
+
+def _part_path(upload_id):
+    return os.path.join(config.PARTIAL_UPLOAD_FOLDER, upload_id + ".part")
+
+
+def _load_state(upload_id):
+    # Ids are uuid4 hex; reject anything else before touching the disk.
+    if len(upload_id) != 32 or not all(c in "0123456789abcdef" for c in upload_id):
+        return None
+    return read_json(_state_path(upload_id), None)
+
+
+def _hasher_at(upload_id, offset):
+    with _hashers_lock:
+        cached = _hashers.get(upload_id)
+    if cached and cached[0] == offset:
+        return cached[1].copy()
+    hasher = hashlib.sha256()
+    with open(_part_path(upload_id), "rb") as f:
+        remaining = offset
+        while remaining:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def _discard(upload_id):
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+    for path in (_part_path(upload_id), _state_path(upload_id), _state_path(upload_id) + ".lock"):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _status(state):
+    return {
+        "upload_id": state["upload_id"],
+        "filename": state["filename"],
+        "offset": state["offset"],
+        "size": state["size"],
+        "max_size": config.MAX_UPLOAD_SIZE,
+    }
+
+
+def _owned_state(upload_id):
+    """Load an upload session belonging to the logged-in issuer, or return an error response."""
+    if 'user' not in session or session.get('role') != 'issuer':
+        return None, (jsonify({"error": "Unauthorized"}), 403)
+    state = _load_state(upload_id)
+    if state is None or state["issuer"] != session['user']:
+        return None, (jsonify({"error": "Unknown upload"}), 404)
+    return state, None
+
+
+@chunked_upload.route("/uploads", methods=["POST"])
+def init_upload():
+    """Start a chunked upload: JSON body with filename, optional size and custodians."""
+    if 'user' not in session or session.get('role') != 'issuer':
+        return jsonify({"error": "Unauthorized"}), 403
+
+    issuer = session['user']
+    body = request.get_json(silent=True) or {}
+    filename = secure_filename(body.get("filename", ""))
+    size = body.get("size")
+    custodians = body.get("custodians", [])
+
+    if not filename or not allowed_file(filename):
+        return jsonify({"error": "Invalid file type"}), 400
+    if size is not None and (not isinstance(size, int) or size < 0):
+        return jsonify({"error": "size must be a non-negative integer"}), 400
+    if size is not None and size > config.MAX_UPLOAD_SIZE:
+        return jsonify({"error": "File too large", "max_size": config.MAX_UPLOAD_SIZE}), 413
+
+    acl = get_acl()
+    invalid_custodians = [c for c in custodians if not acl.linked(issuer, c)]
+    if invalid_custodians:
+        return jsonify({"error": f"Invalid custodians: {', '.join(invalid_custodians)}"}), 400
+
+    upload_id = uuid.uuid4().hex
+    state = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "issuer": issuer,
+        "custodians": custodians,
+        "size": size,
+        "offset": 0,
+    }
+    open(_part_path(upload_id), "wb").close()
+    atomic_write_json(_state_path(upload_id), state)
+    return jsonify(_status(state)), 201
+
+
+@chunked_upload.route("/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    """Report the committed offset so an interrupted client knows where to resume."""
+    state, error = _owned_state(upload_id)
+    if error:
+        return error
+    return jsonify(_status(state)), 200
+
+
+@chunked_upload.route("/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    """Append the request body at ``?offset=``, which must equal the committed offset."""
+    state, error = _owned_state(upload_id)
+    if error:
+        return error
+    try:
+        offset = int(request.args["offset"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "offset query parameter is required"}), 400
+
+    limit = config.MAX_UPLOAD_SIZE if state["size"] is None else state["size"]
+    declared = request.content_length
+    if declared is not None and offset + declared > limit:
+        return jsonify({"error": "Chunk exceeds upload size", "max_size": limit}), 413
+
+    with file_lock(_state_path(upload_id)):
+        state = _load_state(upload_id)
+        if state is None:
+            return jsonify({"error": "Unknown upload"}), 404
+        if offset != state["offset"]:
+            return jsonify({"error": "Offset mismatch", "offset": state["offset"]}), 409
+
+        hasher = _hasher_at(upload_id, offset)
+        written = offset
+        with open(_part_path(upload_id), "r+b") as part:
+            # Drop any tail left by a chunk whose connection died mid-body.
+            part.truncate(offset)
+            part.seek(offset)
+            while True:
+                block = request.stream.read(READ_BLOCK_SIZE)
+                if not block:
+                    break
+                written += len(block)
+                if written > limit:
+                    part.truncate(offset)
+                    return jsonify({"error": "Chunk exceeds upload size", "max_size": limit}), 413
+                hasher.update(block)
+                part.write(block)
+            part.flush()
+            os.fsync(part.fileno())
+
+        state["offset"] = written
+        atomic_write_json(_state_path(upload_id), state)
+        now = time.monotonic()
+        with _hashers_lock:
+            for stale in [k for k, v in _hashers.items() if now - v[2] > config.PARTIAL_UPLOAD_TTL]:
+                del _hashers[stale]
+            _hashers[upload_id] = (written, hasher, now)
+
+    return jsonify(_status(state)), 200
+
+
+@chunked_upload.route("/uploads/<upload_id>/finalize", methods=["POST"])
+def finalize_upload(upload_id):
+    """Move the spooled file into the blob store and record its metadata."""
+    state, error = _owned_state(upload_id)
+    if error:
+        return error
+
+    with file_lock(_state_path(upload_id)):
+        state = _load_state(upload_id)
+        if state is None:
+            return jsonify({"error": "Unknown upload"}), 404
+        if state["size"] is not None and state["offset"] != state["size"]:
+            return jsonify({"error": "Upload incomplete", "offset": state["offset"]}), 409
+
+        sha256 = _hasher_at(upload_id, state["offset"]).hexdigest()
+        # A duplicate of an existing blob is dropped rather than written again.
+        with span("file.save"):
+            blobstore.adopt(_part_path(upload_id), sha256)
+
+        # An existing name gets a new version; its custodians stay as they are
+        existing = get_store().get_file(state["issuer"], state["filename"])
+        if existing is not None:
+            with span("metadata.save"):
+                version = add_version(existing, sha256, state["offset"])
+            job_id = None
+            if version is not None:
+                job_id = get_queue().enqueue(
+                    "process_upload", existing["id"], sha256=sha256, filename=state["filename"],
+                    record_id=existing["id"], version=version,
+                )
+                bump_generation()
+            _discard(upload_id)
+            return jsonify({
+                "message": "New version uploaded" if version else "File is unchanged",
+                "filename": state["filename"],
+                "size": state["offset"],
+                "sha256": sha256,
+                "version": version,
+                "job_id": job_id,
+            }), 201 if version else 200
+
+        file_metadata = build_file_metadata(
+            state["filename"], state["offset"], state["issuer"], state["custodians"], sha256
+        )
+        with span("metadata.save"):
+            file_id = get_store().add_file(file_metadata)
+        get_acl().file_added(dict(file_metadata, id=file_id))
+        get_search_index().file_added(dict(file_metadata, id=file_id))
+        job_id = get_queue().enqueue(
+            "process_upload", file_id, sha256=sha256, filename=state["filename"]
+        )
+        bump_generation()
+        _discard(upload_id)
+
+    return jsonify({
+        "message": "File uploaded successfully",
+        "filename": state["filename"],
+        "size": state["offset"],
+        "sha256": sha256,
+        "job_id": job_id,
+    }), 201
+
+
+@chunked_upload.route("/uploads/<upload_id>", methods=["DELETE"])
+def abort_upload(upload_id):
+    """Discard an unfinished upload."""
+    state, error = _owned_state(upload_id)
+    if error:
+        return error
+    with file_lock(_state_path(upload_id)):
+        _discard(upload_id)
+    return jsonify({"message": "Upload aborted"}), 200
@@ -1,12 +1,21 @@
 import os
-import json
-from flask import Blueprint, render_template, session, redirect, url_for, flash, request
+import config
+from flask import Blueprint, make_response, render_template, session, redirect, url_for, flash, request
+from jsonstore import CorruptStoreError
+from markupsafe import Markup
+from acl import get_acl, link_users
+from column_stats import load_stats
+from metrics import span
+from downloads import send_zip
+from jobs import get_queue
+from metadata_store import get_store
+from pagination import encode_cursor, page_params
+from render_cache import bump_generation, finish, fragment, revalidate
+from user_directory import get_directory
+from versions import get_versions
 
 custodian_bp = Blueprint("custodian", __name__)
 
-FILES_JSON_PATH = "storage/files.json"
-USER_FILE = "storage/users.json"
-
 @custodian_bp.route('/dashboard')
 def custodian_dashboard():
     if 'user' not in session or session.get('role') != 'custodian':
@@ -14,39 +23,75 @@ def custodian_dashboard():
         return redirect(url_for("auth.login"))
 
     custodian = session['user']
-    
+
+    try:
+        after, limit = page_params(request.args)
+    except ValueError:
+        return redirect(url_for("custodian.custodian_dashboard"))
+    page = (custodian, after, limit)
+    # Polling browsers get a 304 without loading or rendering anything
+    generation, etag, not_modified = revalidate("custodian", page)
+    if not_modified:
+        return not_modified
+
     # Load associated issuers
     issuers = []
-    users = {}
-    if os.path.exists(USER_FILE):
-        with open(USER_FILE, "r") as f:
-            try:
-                users = json.load(f)
-                issuers = users.get(custodian, {}).get("manages", [])
-            except json.JSONDecodeError:
-                flash("Failed to load user data", "danger")
-    
-    # Load metadata and filter relevant files
-    files = []
-    if os.path.exists(FILES_JSON_PATH):
-        with open(FILES_JSON_PATH, "r") as f:
-            try:
-                all_files = json.load(f)
-                for file in all_files:
-                    if (
-                        file.get("issuer") in issuers and
-                        custodian in file.get("custodians", [])
-                    ):
-                        files.append(file)
-            except json.JSONDecodeError:
-                flash("Failed to load file metadata", "danger")
-
-    return render_template(
+    cacheable = True
+    try:
+        issuers = sorted(get_acl().partners(custodian))
+    except CorruptStoreError:
+        flash("Failed to load user data", "danger")
+        cacheable, etag = False, None
+
+    def render_files():
+        # Load one page of files the custodian's issuers shared with them
+        with span("metadata.load"):
+            files, next_key = get_store().page_for_custodian(custodian, issuers, after, limit)
+        return render_template(
+            "custodian_files.html",
+            files=files,
+            job_status=get_queue().statuses_for_files(f["id"] for f in files),
+            stats={f["id"]: load_stats(f["sha256"]) for f in files if f.get("sha256")},
+            versions=get_versions().latest(f["id"] for f in files),
+            next_cursor=encode_cursor(next_key),
+            first_page=after is None,
+            page_limit=limit,
+        )
+
+    response = make_response(render_template(
     "custodian_dashboard.html",
     custodian=custodian,
-    files=files,
+    files_html=fragment("custodian", page, generation, render_files) if cacheable else Markup(render_files()),
     issuers=issuers
-    )
+    ))
+    return finish(response, etag)
+
+
+@custodian_bp.route('/export.zip')
+def export_files():
+    """Stream every file visible to the custodian as one ZIP.
+
+    Optional filters: ?issuer=<username>&since=YYYY-MM-DD&until=YYYY-MM-DD
+    (both dates inclusive).
+    """
+    if 'user' not in session or session.get('role') != 'custodian':
+        flash("Unauthorized access.", "danger")
+        return redirect(url_for("auth.login"))
+
+    custodian = session['user']
+    issuers = get_acl().partners(custodian)
+    issuer = request.args.get("issuer", "").strip()
+    if issuer:
+        issuers = [issuer] if issuer in issuers else []
+    since = request.args.get("since", "").strip()
+    until = request.args.get("until", "").strip()
+
+    files = [
+        f for f in get_store().files_for_custodian(custodian, issuers)
+        if (not since or f["upload_time"] >= since)
+        and (not until or f["upload_time"][:len(until)] <= until)
+    ]
+    return send_zip(files, f"{custodian}-files.zip")
 
 
 @custodian_bp.route('/add_issuer', methods=['POST'])
@@ -63,29 +108,30 @@ def add_issuer():
         return redirect(url_for("custodian.custodian_dashboard"))
 
     # Load users
-    USER_FILE = "storage/users.json"
-    if not os.path.exists(USER_FILE):
+    if not os.path.exists(config.USER_FILE):
         flash("User database not found.", "danger")
         return redirect(url_for("custodian.custodian_dashboard"))
 
-    with open(USER_FILE, "r") as f:
-        users = json.load(f)
+    def link_issuer(users):
+        # Validate issuer
+        if new_issuer not in users or users[new_issuer].get("role") != "issuer":
+            return "invalid"
+        # Add to both 'manages' lists so the two sides stay in step
+        return "added" if link_users(users, new_issuer, custodian) else False
 
-    # Validate issuer
-    if new_issuer not in users or users[new_issuer].get("role") != "issuer":
+    with span("users.save"):
+        result = get_directory().update(link_issuer)
+    if result == "added":
+        get_acl().link(new_issuer, custodian)
+        bump_generation()
+    if result == "invalid":
         flash("Invalid issuer username.", "danger")
         return redirect(url_for("custodian.custodian_dashboard"))
 
-    # Add issuer to custodian's 'manages' list
-    manages = users[custodian].get("manages", [])
-    if new_issuer in manages:
-        flash("Issuer already associated with you.", "info")
-    else:
-        manages.append(new_issuer)
-        users[custodian]["manages"] = manages
-        with open(USER_FILE, "w") as f:
-            json.dump(users, f, indent=4)
+    if result == "added":
         flash(f"Issuer '{new_issuer}' added successfully!", "success")
+    else:
+        flash("Issuer already associated with you.", "info")
 
     return redirect(url_for("custodian.custodian_dashboard"))
 
@@ -1,51 +1,22 @@
-import json
-import os, mimetypes
-from datetime import datetime
-from flask import Blueprint, render_template, session, redirect, url_for, flash, request
+import os
+from flask import Blueprint, make_response, render_template, session, redirect, url_for, flash, request
 from werkzeug.utils import secure_filename
+import blobstore
+import config
+from acl import get_acl, link_users
+from column_stats import load_stats
+from metrics import span
+from jobs import get_queue
+from metadata_store import get_store
+from pagination import encode_cursor, page_params
+from render_cache import bump_generation, finish, fragment, revalidate
+from search_index import get_search_index
+from user_directory import get_directory
+from utils import allowed_file, build_file_metadata
+from versions import add_version, get_versions
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
-FILES_JSON_PATH = "storage/files.json"  # Update the path if necessary
-USER_FILE = "storage/users.json" 
-UPLOAD_FOLDER = "uploads"
-
-
-# Constants
-ALLOWED_EXTENSIONS = {"csv", "xlsx", "xls"}
-os.makedirs("storage", exist_ok=True)
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-# Utilities
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def get_mime_type(filename):
-    mime_type, _ = mimetypes.guess_type(filename)
-    return mime_type or "application/octet-stream"
-
-def load_metadata():
-    if not os.path.exists(FILES_JSON_PATH):
-        return []
-    try:
-        with open(FILES_JSON_PATH, "r") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return []
-
-def save_metadata(metadata):
-    with open(FILES_JSON_PATH, "w") as f:
-        json.dump(metadata, f, indent=4)
-
-def load_users():
-    if not os.path.exists(USER_FILE):
-        return {}
-    with open(USER_FILE, "r") as f:
-        return json.load(f)
-
-def file_exists(filename):
-    return os.path.exists(os.path.join(UPLOAD_FOLDER, filename))
-
 @dashboard_bp.route('/', methods=['GET', 'POST'])
 def dashboard():
     if 'user' not in session or session.get('role') != 'issuer':
@@ -53,7 +24,7 @@ def dashboard():
         return redirect(url_for('auth.login'))
 
     username = session['user']
-    users = load_users()
+    acl = get_acl()
 
     # Handle File Upload (POST)
     if request.method == 'POST':
@@ -71,61 +42,88 @@ def dashboard():
             return redirect(url_for('dashboard.dashboard'))
 
         filename = secure_filename(file.filename)
-        if file_exists(filename):
-            flash("File with this name already exists.", "warning")
-            return redirect(url_for('dashboard.dashboard'))
-
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        # Uploading an existing name adds a version of that file
+        existing = get_store().get_file(username, filename)
 
         # Get selected custodians from form
         form_custodians = request.form.getlist("custodians")
-        valid_custodians = users.get(username, {}).get("manages", [])
 
         # Validate selection
-        invalid_custodians = [c for c in form_custodians if c not in valid_custodians]
+        invalid_custodians = [c for c in form_custodians if not acl.linked(username, c)]
         if invalid_custodians:
             flash(f"Invalid custodian(s): {', '.join(invalid_custodians)}", "danger")
             return redirect(url_for('dashboard.dashboard'))
 
         custodians = form_custodians
 
+        # Identical content is stored once, whoever uploads it
+        with span("file.save"):
+            sha256, size = blobstore.put_stream(file.stream)
+
+        if existing is not None:
+            # A new version keeps the file's custodians
+            with span("metadata.save"):
+                version = add_version(existing, sha256, size)
+            if version is None:
+                flash("File is unchanged; no new version was stored.", "info")
+            else:
+                get_queue().enqueue(
+                    "process_upload", existing["id"], sha256=sha256, filename=filename,
+                    record_id=existing["id"], version=version,
+                )
+                bump_generation()
+                flash(f"Uploaded version {version} of {filename}.", "success")
+            return redirect(url_for('dashboard.dashboard'))
+
         # Build metadata
-        file_metadata = {
-            "filename": filename,
-            "size": os.path.getsize(filepath),
-            "upload_time": datetime.utcnow().isoformat(),
-            "mime_type": get_mime_type(filename),
-            "issuer": username,
-            "custodians": custodians
-        }
-
-        metadata = load_metadata()
-        metadata.append(file_metadata)
-        save_metadata(metadata)
+        file_metadata = build_file_metadata(filename, size, username, custodians, sha256)
+
+        with span("metadata.save"):
+            file_id = get_store().add_file(file_metadata)
+        acl.file_added(dict(file_metadata, id=file_id))
+        get_search_index().file_added(dict(file_metadata, id=file_id))
+        # Parsing and checksums run in the background pool
+        get_queue().enqueue("process_upload", file_id, sha256=sha256, filename=filename)
+        bump_generation()
 
         flash("File uploaded successfully!", "success")
         return redirect(url_for('dashboard.dashboard'))
 
-    # Load issuer files for dashboard
-    files = []
-    if os.path.exists(FILES_JSON_PATH):
-        with open(FILES_JSON_PATH, "r") as f:
-            try:
-                all_files = json.load(f)
-                files = [f for f in all_files if f.get("issuer") == username]
-            except json.JSONDecodeError:
-                files = []
+    # Load one page of issuer files for dashboard
+    try:
+        after, limit = page_params(request.args)
+    except ValueError:
+        return redirect(url_for('dashboard.dashboard'))
+    page = (username, after, limit)
+    # Polling browsers get a 304 without loading or rendering anything
+    generation, etag, not_modified = revalidate("issuer", page)
+    if not_modified:
+        return not_modified
+
+    def render_files():
+        with span("metadata.load"):
+            files, next_key = get_store().page_for_issuer(username, after, limit)
+        return render_template(
+            'issuer_files.html',
+            files=files,
+            job_status=get_queue().statuses_for_files(f["id"] for f in files),
+            stats={f["id"]: load_stats(f["sha256"]) for f in files if f.get("sha256")},
+            versions=get_versions().latest(f["id"] for f in files),
+            next_cursor=encode_cursor(next_key),
+            first_page=after is None,
+            page_limit=limit,
+        )
 
     # Load manually associated custodians
-    associated_custodians = users.get(username, {}).get("manages", [])
+    associated_custodians = sorted(acl.partners(username))
 
-    return render_template(
+    response = make_response(render_template(
         'dashboard.html',
         username=username,
-        files=files,
+        files_html=fragment("issuer", page, generation, render_files),
         custodians=associated_custodians
-    )
+    ))
+    return finish(response, etag)
 
 
 
@@ -143,26 +141,26 @@ def add_custodian():
         return redirect(url_for('dashboard.dashboard'))
 
     # Load users
-    if not os.path.exists(USER_FILE):
+    if not os.path.exists(config.USER_FILE):
         flash("User database not found", "danger")
         return redirect(url_for('dashboard.dashboard'))
 
-    with open(USER_FILE, 'r') as f:
-        users = json.load(f)
-
-    if new_custodian not in users or users[new_custodian].get("role") != "custodian":
+    def link_custodian(users):
+        if new_custodian not in users or users[new_custodian].get("role") != "custodian":
+            return "invalid"
+        # Add to both 'manages' lists so the two sides stay in step
+        return "added" if link_users(users, issuer, new_custodian) else False
+
+    with span("users.save"):
+        result = get_directory().update(link_custodian)
+    if result == "added":
+        get_acl().link(issuer, new_custodian)
+        bump_generation()
+    if result == "invalid":
         flash("That user is not a valid custodian", "danger")
         return redirect(url_for('dashboard.dashboard'))
 
-    # Add to issuer's 'manages' list
-    manages = users[issuer].get("manages", [])
-    if new_custodian not in manages:
-        manages.append(new_custodian)
-        users[issuer]["manages"] = manages
-
-        with open(USER_FILE, 'w') as f:
-            json.dump(users, f, indent=4)
-
+    if result == "added":
         flash(f"Custodian '{new_custodian}' added successfully", "success")
     else:
         flash(f"Custodian '{new_custodian}' is already associated with you", "info")
@@ -1,77 +1,166 @@
 import os
-import json
-import mimetypes
-from datetime import datetime
-from flask import Blueprint, request, jsonify
+import zipfile
+import zlib
+from flask import Blueprint, Response, request, jsonify, session
 from werkzeug.utils import secure_filename
-from flask import send_from_directory, abort
+from flask import abort
+import blobstore
+from acl import get_acl
+from column_stats import load_stats
+from metrics import span
+import config
+from downloads import send_stored_file, send_stream
+from jobs import get_queue
+from metadata_store import get_store
+from models import file_page, json_encoder
+from pagination import encode_cursor, page_params
+from render_cache import bump_generation
+from search_index import get_search_index
+from user_directory import get_directory
+from utils import allowed_file, build_file_metadata
+from versions import add_version, get_versions, iter_version
 
 file_upload = Blueprint("file_upload", __name__)
 
-UPLOAD_FOLDER = "uploads"
-FILES_FILE = "files.json"
-METADATA_FILE = "storage/files.json"
-ALLOWED_EXTENSIONS = {"csv", "xlsx", "xls"}
-
-# Ensure required directories exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs("storage", exist_ok=True)
-
-def allowed_file(filename):
-    """Check if the file has an allowed extension."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def get_mime_type(filename):
-    """Get the MIME type of a file."""
-    mime_type, _ = mimetypes.guess_type(filename)
-    return mime_type if mime_type else "application/octet-stream"
-
-
-def load_metadata():
-    """Load metadata from files.json, handling corruption issues."""
-    if not os.path.exists(METADATA_FILE):
-        return []  # Return an empty list if file doesn't exist
-
-    try:
-        with open(METADATA_FILE, "r") as f:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
-    except (json.JSONDecodeError, IOError):
-        return []  # Return an empty list if there's an issue
-
-
-def save_metadata(metadata):
-    """Save metadata safely, preventing file corruption."""
-    try:
-        with open(METADATA_FILE, "w") as f:
-            json.dump(metadata, f, indent=4)
-    except IOError as e:
-        print(f"Error saving metadata: {e}")
-
-# Function to check if a file with the same name already exists
-def file_exists(filename):
-    """Check if the file already exists in the upload folder."""
-    return os.path.exists(os.path.join(UPLOAD_FOLDER, filename))
+def resolve_file(filename, issuer=None):
+    """Find the record a download of ``filename`` refers to.
+
+    Names are only unique per issuer, so without an explicit issuer prefer
+    a file the logged-in user uploaded or was given access to.
+    """
+    if issuer:
+        return get_store().get_file(issuer, filename)
+    matches = get_store().find_files(filename)
+    user = session.get('user')
+    acl = get_acl()
+    for record in matches:
+        if acl.can_read(user, record["id"]):
+            return record
+    return matches[-1] if matches else None
 
 # Function to validate if a custodian exists (this will be based on a mock user validation)
-def is_valid_custodian(username):
+def is_valid_custodian(username, users=None):
     """Check if the given username is a valid custodian."""
-    # Here you would normally query a database or another file (e.g., users.json)
-    # For simplicity, let's assume all custodians are valid if they are non-empty strings.
-    users = load_users()  # Assuming we have a function to load users from a file or DB
-    return username in users and users[username]["role"] == "custodian"
-
-def load_users():
-    """Load users from a mock user database (users.json)."""
-    USER_FILE = "storage/users.json"
-    if not os.path.exists(USER_FILE):
-        return {}
-    with open(USER_FILE, "r") as f:
-        return json.load(f)
+    # Callers validating several names should pass one snapshot for all of them.
+    users = users or get_directory().snapshot()
+    return users.has_role(username, "custodian")
+
+@file_upload.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """Upload many files at once: several "file" parts, or one ZIP as "archive".
+
+    Custodians are checked once for the whole batch and every new file's
+    metadata is committed in a single write. ZIP members are streamed from
+    the archive into the blob store without being extracted first. Names
+    the issuer already uses get a new version, as with /upload. Returns a
+    result per file.
+    """
+    if 'user' not in session or session.get('role') != 'issuer':
+        return jsonify({"error": "Unauthorized"}), 403
+    issuer = session['user']
+    # A batch may carry many files of up to MAX_UPLOAD_SIZE each; must be
+    # set before the body is parsed.
+    request.max_content_length = config.BATCH_MAX_REQUEST_SIZE
+
+    custodians = [c.strip() for c in request.form.get('custodians', '').split(',') if c.strip()]
+    acl = get_acl()
+    invalid_custodians = [c for c in custodians if not acl.linked(issuer, c)]
+    if invalid_custodians:
+        return jsonify({"error": f"Invalid custodians: {', '.join(invalid_custodians)}"}), 400
+
+    archive = None
+    if "archive" in request.files:
+        try:
+            archive = zipfile.ZipFile(request.files["archive"].stream)
+        except zipfile.BadZipFile:
+            return jsonify({"error": "Invalid ZIP archive"}), 400
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        # zipfile stops each member at its declared size, so these sizes
+        # bound what the archive can expand to.
+        if sum(info.file_size for info in members) > config.BATCH_MAX_BYTES:
+            archive.close()
+            return jsonify({"error": "Archive too large", "max_bytes": config.BATCH_MAX_BYTES}), 413
+        entries = [(info.filename.rsplit("/", 1)[-1], info) for info in members]
+    else:
+        entries = [(f.filename, f) for f in request.files.getlist("file")]
+
+    store = get_store()
+    results, new_files, seen = [], [], set()
+    try:
+        if not entries:
+            return jsonify({"error": "No files"}), 400
+        if len(entries) > config.BATCH_MAX_FILES:
+            return jsonify({"error": "Too many files", "max_files": config.BATCH_MAX_FILES}), 413
+        for name, entry in entries:
+            filename = secure_filename(name or "")
+            if not filename or not allowed_file(filename):
+                results.append({"filename": name, "status": "rejected", "error": "Invalid file type"})
+                continue
+            if filename in seen:
+                results.append({"filename": filename, "status": "rejected", "error": "Duplicate name in batch"})
+                continue
+            seen.add(filename)
+            if archive is not None:
+                if entry.file_size > config.MAX_UPLOAD_SIZE:
+                    results.append({"filename": filename, "status": "rejected", "error": "File too large"})
+                    continue
+                if entry.file_size > 1 << 20 and entry.file_size > config.BATCH_MAX_RATIO * entry.compress_size:
+                    results.append(
+                        {"filename": filename, "status": "rejected", "error": "Implausible compression ratio"}
+                    )
+                    continue
+            try:
+                with span("file.save"), (archive.open(entry) if archive is not None else entry.stream) as stream:
+                    sha256, size = blobstore.put_stream(stream, max_size=config.MAX_UPLOAD_SIZE)
+            except ValueError:
+                results.append({"filename": filename, "status": "rejected", "error": "File too large"})
+                continue
+            except (zipfile.BadZipFile, RuntimeError, zlib.error) as e:
+                # Corrupt or encrypted archive member
+                results.append({"filename": filename, "status": "rejected", "error": f"Unreadable: {e}"})
+                continue
+
+            existing = store.get_file(issuer, filename)
+            if existing is None:
+                new_files.append(build_file_metadata(filename, size, issuer, custodians, sha256))
+                results.append({"filename": filename, "status": "created", "size": size, "sha256": sha256})
+                continue
+            with span("metadata.save"):
+                version = add_version(existing, sha256, size)
+            result = {"filename": filename, "status": "version" if version else "unchanged", "version": version}
+            if version is not None:
+                result["job_id"] = get_queue().enqueue(
+                    "process_upload", existing["id"], sha256=sha256, filename=filename,
+                    record_id=existing["id"], version=version,
+                )
+            results.append(result)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    # One write for every new record
+    with span("metadata.save"):
+        file_ids = store.add_files(new_files)
+    records = [dict(record, id=file_id) for record, file_id in zip(new_files, file_ids)]
+    acl.files_added(records)
+    get_search_index().files_added(records)
+    created = [r for r in results if r["status"] == "created"]
+    for result, record in zip(created, records):
+        result["job_id"] = get_queue().enqueue(
+            "process_upload", record["id"], sha256=record["sha256"], filename=record["filename"]
+        )
+
+    stored = sum(r["status"] in ("created", "version") for r in results)
+    if stored:
+        bump_generation()
+    return jsonify({"files": results, "stored": stored}), 201 if stored else 200
 
 @file_upload.route("/upload", methods=["POST"])
 def upload_file():
-    """Handle file upload and add metadata to files.json."""
+    """Handle file upload and record its metadata in the metadata store."""
+    if 'user' not in session or session.get('role') != 'issuer':
+        return jsonify({"error": "Unauthorized"}), 403
+
     if "file" not in request.files:
         return jsonify({"error": "No file part"}), 400
 
@@ -81,38 +170,50 @@ def upload_file():
 
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        
-        # Check if the file already exists
-        if file_exists(filename):
-            return jsonify({"error": "File with the same name already exists"}), 400
-        
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)  # Save file to uploads folder
-
-        # Prompt the issuer for custodian usernames
-        custodians_input = request.form.get('custodians')
-        custodians = custodians_input.split(',')
-
-        # Validate custodians
-        invalid_custodians = [custodian for custodian in custodians if not is_valid_custodian(custodian)]
+        issuer = session['user']
+
+        # An existing name gets a new version; its custodians stay as they are
+        existing = get_store().get_file(issuer, filename)
+        if existing is not None:
+            with span("file.save"):
+                sha256, size = blobstore.put_stream(file.stream)
+            with span("metadata.save"):
+                version = add_version(existing, sha256, size)
+            if version is None:
+                return jsonify({"message": "File is unchanged", "filename": filename}), 200
+            job_id = get_queue().enqueue(
+                "process_upload", existing["id"], sha256=sha256, filename=filename,
+                record_id=existing["id"], version=version,
+            )
+            bump_generation()
+            return jsonify({
+                "message": "New version uploaded", "filename": filename, "version": version, "job_id": job_id,
+            }), 201
+
+        custodians = [c.strip() for c in request.form.get('custodians', '').split(',') if c.strip()]
+
+        # Custodians must be linked to the issuer, or they could never read the file
+        with span("users.load"):
+            acl = get_acl()
+            invalid_custodians = [c for c in custodians if not acl.linked(issuer, c)]
         if invalid_custodians:
             return jsonify({"error": f"Invalid custodians: {', '.join(invalid_custodians)}"}), 400
 
+        # Save file to the content-addressed blob store
+        with span("file.save"):
+            sha256, size = blobstore.put_stream(file.stream)
+
         # Store metadata
-        metadata = load_metadata()
-        file_metadata = {
-            "filename": filename,
-            "size": os.path.getsize(filepath),
-            "upload_time": datetime.utcnow().isoformat(),
-            "mime_type": get_mime_type(filename),
-            "issuer": request.form.get('issuer'),  # Assuming issuer is passed in the form
-            "custodians": custodians
-        }
+        file_metadata = build_file_metadata(filename, size, issuer, custodians, sha256)
 
-        metadata.append(file_metadata)  # Append new file entry
-        save_metadata(metadata)  # Write back to files.json
+        with span("metadata.save"):
+            file_id = get_store().add_file(file_metadata)
+        acl.file_added(dict(file_metadata, id=file_id))
+        get_search_index().file_added(dict(file_metadata, id=file_id))
+        job_id = get_queue().enqueue("process_upload", file_id, sha256=sha256, filename=filename)
+        bump_generation()
 
-        return jsonify({"message": "File uploaded successfully", "filename": filename}), 201
+        return jsonify({"message": "File uploaded successfully", "filename": filename, "job_id": job_id}), 201
 
     return jsonify({"error": "Invalid file type"}), 400
 
@@ -150,8 +251,8 @@ def upload_file():
     save_files(files)
 
     # Simulate saving the file
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    with open(os.path.join(UPLOAD_FOLDER, filename), "w") as f:
+    os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
+    with open(os.path.join(config.UPLOAD_FOLDER, filename), "w") as f:
         f.write("")  # Placeholder for actual file content
 
     print(f"File '{filename}' uploaded successfully and assigned to custodians: {valid_custodians}")
@@ -159,37 +260,142 @@ def upload_file():
 if __name__ == "__main__":
     upload_file()
 
+def _download_version(record, filename, version):
+    """Send one version of a file: its own blob if it still has one, else rebuilt from deltas."""
+    try:
+        version = int(version)
+    except ValueError:
+        return jsonify({"error": "version must be an integer"}), 400
+    entry = get_versions().get(record["id"], version)
+    if entry is None:
+        # A file that was never re-uploaded is its own version 1.
+        if version == 1 and get_versions().current(record["id"]) is None:
+            path = blobstore.file_path(record)
+            if os.path.exists(path):
+                return send_stored_file(path, filename, record)
+        return jsonify({"error": "Version not found"}), 404
+    stored = dict(record, sha256=entry["sha256"], size=entry["size"], upload_time=entry["upload_time"])
+    path = blobstore.stored_path(entry["sha256"])
+    if path is not None:
+        return send_stored_file(path, filename, stored)
+    return send_stream(iter_version(record["id"], entry["version"]), filename, stored)
+
 @file_upload.route("/download/<filename>", methods=["GET"])
 def download_file(filename):
     """Allow secure downloading of uploaded files."""
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
     try:
         # Ensure filename is safe
         filename = secure_filename(filename)
 
-        # Get the full file path
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # Only files the user uploaded or was given access to
+        record = resolve_file(filename, request.args.get("issuer"))
+        if record is None or not get_acl().can_read(session['user'], record["id"]):
+            return jsonify({"error": "File not found"}), 404
+        if request.args.get("version"):
+            return _download_version(record, filename, request.args["version"])
+        filepath = blobstore.file_path(record)
+        # A new version keeps the record's first upload_time; Last-Modified
+        # must move with the content.
+        current = get_versions().current(record["id"])
+        if current is not None and current["sha256"] == record.get("sha256"):
+            record = dict(record, upload_time=current["upload_time"])
 
         # Check if file exists
         if not os.path.exists(filepath):
             return jsonify({"error": "File not found"}), 404
 
-        # Send the file as a download attachment
-        return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True)
+        # Send the file as a download attachment (304s, ranges, sendfile)
+        return send_stored_file(filepath, filename, record)
 
     except Exception as e:
         print(f"Download error: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@file_upload.route("/preview/<filename>", methods=["GET"])
+def preview_file(filename):
+    """Return a page of rows from a spreadsheet's columnar cache.
+
+    Query parameters: issuer, sheet (index), offset, limit and columns
+    (comma-separated names). The original file is never re-parsed.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    record = resolve_file(secure_filename(filename), request.args.get("issuer"))
+    if record is None or not get_acl().can_read(session['user'], record["id"]):
+        return jsonify({"error": "File not found"}), 404
+    if not record.get("sha256"):
+        return jsonify({"error": "No preview available for this file"}), 404
+
+    try:
+        sheet = int(request.args.get("sheet", 0))
+        offset = int(request.args.get("offset", 0))
+        limit = min(int(request.args.get("limit", 100)), config.PREVIEW_MAX_ROWS)
+    except ValueError:
+        return jsonify({"error": "sheet, offset and limit must be integers"}), 400
+    columns = [c for c in request.args.get("columns", "").split(",") if c] or None
+
+    # numpy comes in with columnar; workers that never preview skip it.
+    import columnar
+
+    try:
+        page = columnar.read_page(record["sha256"], sheet, offset, limit, columns)
+    except KeyError as e:
+        return jsonify({"error": f"Unknown {e.args[0]}"}), 400
+    if page is None:
+        return jsonify({"error": "Preview not ready yet"}), 409
+
+    return jsonify(page), 200
+
+@file_upload.route("/stats/<filename>", methods=["GET"])
+def file_stats(filename):
+    """Return the column statistics computed for a spreadsheet at upload.
+
+    Per sheet and column: dtype, nulls, an estimated distinct count and,
+    for numeric columns, min/max/sum/mean. Query parameter: issuer.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    record = resolve_file(secure_filename(filename), request.args.get("issuer"))
+    if record is None or not get_acl().can_read(session['user'], record["id"]):
+        return jsonify({"error": "File not found"}), 404
+    if not record.get("sha256"):
+        return jsonify({"error": "No statistics available for this file"}), 404
+
+    stats = load_stats(record["sha256"])
+    if stats is None:
+        return jsonify({"error": "Statistics not ready yet"}), 409
+    return jsonify(stats), 200
+
 @file_upload.route("/issuer/files", methods=["GET"])
 def get_files_for_issuer():
-    """Return a list of files uploaded by the issuer along with custodians."""
-    issuer = request.args.get("issuer")  # Assuming the issuer is provided in query parameters
-    metadata = load_metadata()
-    
-    # Filter files by issuer
-    user_files = [file for file in metadata if file["issuer"] == issuer]
-    
-    return jsonify({"files": user_files}), 200
+    """Return a page of files uploaded by the issuer along with custodians.
+
+    ``issuer`` defaults to the logged-in user; anyone else only sees the
+    files that issuer shared with them. Newest first; follow ``next_cursor``
+    with ?cursor= for the next page.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+    user = session['user']
+    issuer = request.args.get("issuer") or user
+    try:
+        after, limit = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    with span("metadata.load"):
+        if issuer == user:
+            user_files, next_key = get_store().page_for_issuer(issuer, after, limit)
+        elif get_acl().linked(user, issuer):
+            user_files, next_key = get_store().page_for_custodian(user, [issuer], after, limit)
+        else:
+            user_files, next_key = [], None
+
+    body = json_encoder.encode(file_page(user_files, encode_cursor(next_key)))
+    return Response(body, 200, mimetype="application/json")
 
 # custodian download functionality 
 custodian_bp = Blueprint('custodian', __name__)
@@ -207,4 +413,38 @@ def custodian_dashboard():
     # Fetch files from these issuers
     files = db.session.query(File).filter(File.custodian_id == custodian_id).all()
 
-    return render_template('custodian_dashboard.html', issuers=issuers, files=files)
\ No newline at end of file
+    return render_template('custodian_dashboard.html', issuers=issuers, files=files)
+
+@file_upload.route("/versions/<filename>", methods=["GET"])
+def file_versions(filename):
+    """List a file's versions, oldest first; /download/<filename>?version=<n> fetches one.
+
+    Query parameter: issuer. ``stored_size`` is what each version costs on
+    disk: its delta, or its full size when kept whole.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    record = resolve_file(secure_filename(filename), request.args.get("issuer"))
+    if record is None or not get_acl().can_read(session['user'], record["id"]):
+        return jsonify({"error": "File not found"}), 404
+
+    history = get_versions().history(record["id"]) or [{
+        "version": 1, "sha256": record.get("sha256"), "size": record.get("size"),
+        "upload_time": record["upload_time"], "stored": "snapshot", "delta_size": None,
+    }]
+    return jsonify({
+        "filename": record["filename"],
+        "issuer": record["issuer"],
+        "versions": [
+            {
+                "version": v["version"],
+                "sha256": v["sha256"],
+                "size": v["size"],
+                "upload_time": v["upload_time"],
+                "stored": v["stored"],
+                "stored_size": v["delta_size"] if v["stored"] == "delta" else v["size"],
+            }
+            for v in history
+        ],
+    }), 200
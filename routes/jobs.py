@@ -0,0 +1,27 @@
+from flask import Blueprint, jsonify, session
+from acl import get_acl
+from jobs import get_queue
+
+jobs_bp = Blueprint("jobs", __name__)
+
+
+@jobs_bp.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """Return the state of a background job on one of the user's files."""
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    job = get_queue().get(job_id)
+    if job is None or not get_acl().can_read(session['user'], job["file_id"]):
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify({
+        "id": job["id"],
+        "kind": job["kind"],
+        "file_id": job["file_id"],
+        "status": job["status"],
+        "result": job["result"],
+        "error": job["error"],
+        "created": job["created"],
+        "updated": job["updated"],
+    }), 200
@@ -0,0 +1,83 @@
+from datetime import date
+
+from flask import Blueprint, Response, jsonify, request, session
+
+from acl import get_acl
+from content_index import get_content_index
+from metadata_store import get_store
+from metrics import span
+from models import content_hits, file_page, json_encoder
+from pagination import encode_cursor, page_params
+from search_index import get_search_index
+
+search_bp = Blueprint("search", __name__)
+
+
+def _date_arg(name):
+    """?since= / ?until= as a YYYY-MM-DD string; ValueError if malformed."""
+    value = request.args.get(name, "").strip()
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f"{name} must be a YYYY-MM-DD date") from None
+
+
+@search_bp.route("/search", methods=["GET"])
+def search_files():
+    """Search the files visible to the logged-in user.
+
+    Query parameters (all optional, combined with AND): q (filename words,
+    each matched as a prefix), issuer, custodian, mime_type, since and until
+    (inclusive dates), plus cursor/limit as for /issuer/files.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    try:
+        after, limit = page_params(request.args)
+        since, until = _date_arg("since"), _date_arg("until")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with span("search.query"):
+        ids, next_key = get_search_index().search(
+            get_acl(), session['user'],
+            text=request.args.get("q", ""),
+            issuer=request.args.get("issuer") or None,
+            custodian=request.args.get("custodian") or None,
+            mime_type=request.args.get("mime_type") or None,
+            since=since, until=until, after=after, limit=limit,
+        )
+    with span("metadata.load"):
+        files = get_store().files_by_ids(ids)
+
+    body = json_encoder.encode(file_page(files, encode_cursor(next_key)))
+    return Response(body, 200, mimetype="application/json")
+
+
+@search_bp.route("/search/content", methods=["GET"])
+def search_content():
+    """Find spreadsheet rows containing every word of ?q= in the user's files.
+
+    Each hit names the file, sheet and row; /preview/<filename> with
+    ?sheet=<sheet_index>&offset=<row> shows it. ?limit= caps the hits.
+    """
+    if 'user' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        _, limit = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with span("search.content"):
+        visible = get_acl().readable_ids(session['user'])
+        found, truncated = get_content_index().search(get_store(), visible, text, limit)
+
+    body = json_encoder.encode(content_hits(found, truncated))
+    return Response(body, 200, mimetype="application/json")
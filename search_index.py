@@ -0,0 +1,264 @@
+import bisect
+import heapq
+import re
+import threading
+
+from metadata_store import get_store, page_key
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lower-cased alphanumeric runs: "Q3 Report-2025.xlsx" -> q3, report, 2025, xlsx."""
+    return _TOKEN.findall(text.lower()) if text else []
+
+
+def _add(postings, key, file_id):
+    # Most filename tokens name a single file, so a lone id is stored as a
+    # bare int and only becomes a set when a second file shares the key.
+    ids = postings.get(key)
+    if ids is None:
+        postings[key] = file_id
+    elif isinstance(ids, set):
+        ids.add(file_id)
+    else:
+        postings[key] = {ids, file_id}
+
+
+def _discard(postings, key, file_id):
+    """Remove ``file_id`` from ``key``'s postings; True if none are left."""
+    ids = postings.get(key)
+    if isinstance(ids, set):
+        ids.discard(file_id)
+        if len(ids) == 1:
+            postings[key] = next(iter(ids))
+        return False
+    if ids == file_id:
+        del postings[key]
+        return True
+    return False
+
+
+def _remove_sorted(items, item):
+    position = bisect.bisect_left(items, item)
+    if position < len(items) and items[position] == item:
+        del items[position]
+
+
+def _ids(postings, key):
+    ids = postings.get(key)
+    if ids is None:
+        return set()
+    return ids if isinstance(ids, set) else {ids}
+
+
+class SearchIndex:
+    """In-memory inverted index over file metadata.
+
+    Postings map a filename token, issuer, custodian or MIME type to file
+    ids; ``_terms`` keeps the filename tokens sorted for prefix lookups and
+    ``_by_time`` keeps every record's page key (upload_time, filename, id)
+    sorted for date ranges and newest-first ordering.
+
+    Like acl.AccessIndex, the index follows the metadata store's
+    generation: changes made by other processes are patched in from the
+    store's change log (or rebuilt from scratch when it keeps none), and
+    file_added() patches in uploads made by this process.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._generation = None
+        self._cursor = None
+        self._empty()
+
+    def _empty(self):
+        self._tokens = {}
+        self._terms = []
+        self._issuers = {}
+        self._custodians = {}
+        self._mime_types = {}
+        self._keys = {}
+        self._attributes = {}
+        self._by_time = []
+        self._new_terms = []
+
+    def _index(self, key, issuer, custodians, mime_type):
+        file_id = key[2]
+        self._keys[file_id] = key
+        self._attributes[file_id] = (issuer, custodians, mime_type)
+        for token in set(tokenize(key[1])):
+            if token not in self._tokens:
+                self._new_terms.append(token)
+            _add(self._tokens, token, file_id)
+        if issuer:
+            _add(self._issuers, issuer, file_id)
+        for custodian in custodians:
+            _add(self._custodians, custodian, file_id)
+        if mime_type:
+            _add(self._mime_types, mime_type, file_id)
+
+    def _unindex(self, file_id):
+        key = self._keys.pop(file_id, None)
+        if key is None:
+            return
+        issuer, custodians, mime_type = self._attributes.pop(file_id)
+        for token in set(tokenize(key[1])):
+            if _discard(self._tokens, token, file_id):
+                _remove_sorted(self._terms, token)
+        if issuer:
+            _discard(self._issuers, issuer, file_id)
+        for custodian in custodians:
+            _discard(self._custodians, custodian, file_id)
+        if mime_type:
+            _discard(self._mime_types, mime_type, file_id)
+        _remove_sorted(self._by_time, key)
+
+    def _refresh(self):
+        generation = self._store.generation()
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            changes = None if self._cursor is None else self._store.changes_since(self._cursor)
+            # Patching costs a sorted-list insert per file, so a large
+            # backlog is cheaper to rebuild.
+            if changes is None or len(changes[1]) > len(self._keys) // 4:
+                self._rebuild()
+            else:
+                self._cursor, ids = changes
+                self._patch(ids)
+            self._generation = generation
+
+    def _rebuild(self):
+        self._cursor = self._store.change_cursor()
+        self._empty()
+        for entry in self._store.search_entries():
+            self._index(*entry)
+        self._terms = sorted(self._new_terms)
+        self._by_time = sorted(self._keys.values())
+
+    def _patch(self, ids):
+        """Re-index the records ``ids`` as they are now stored (dropping deleted ones)."""
+        self._new_terms = []
+        for file_id in ids:
+            self._unindex(file_id)
+        for record in self._store.files_by_ids(sorted(ids)):
+            key = page_key(record)
+            self._index(key, record.get("issuer"), tuple(record.get("custodians", ())), record.get("mime_type"))
+            bisect.insort(self._by_time, key)
+        for token in self._new_terms:
+            bisect.insort(self._terms, token)
+
+    def file_added(self, record):
+        """Index a record this process just stored, without a rebuild."""
+        self.files_added([record])
+
+    def files_added(self, records):
+        """Index records this process just stored in one write."""
+        with self._lock:
+            self._new_terms = []
+            for record in records:
+                key = page_key(record)
+                self._unindex(key[2])
+                self._index(key, record.get("issuer"), tuple(record.get("custodians", ())), record.get("mime_type"))
+                bisect.insort(self._by_time, key)
+            for token in self._new_terms:
+                bisect.insort(self._terms, token)
+            if self._store.exact_generation and self._generation is not None:
+                # Only adopt the new generation if ours was the sole write.
+                if self._store.generation() == self._generation + len(records):
+                    self._generation += len(records)
+
+    def _prefix_postings(self, prefix):
+        """Posting sets of every filename token starting with ``prefix``."""
+        terms = self._terms
+        group = []
+        position = bisect.bisect_left(terms, prefix)
+        while position < len(terms) and terms[position].startswith(prefix):
+            group.append(_ids(self._tokens, terms[position]))
+            position += 1
+        return group
+
+    def search(self, access, user, text="", issuer=None, custodian=None, mime_type=None,
+               since=None, until=None, after=None, limit=50):
+        """One page of the files matching every filter that ``user`` may read.
+
+        ``access`` is the acl.AccessIndex. Every word of ``text`` must prefix
+        a filename token. ``since`` and ``until`` compare against upload_time
+        strings, so dates work as inclusive bounds. Results are newest first,
+        paged like MetadataStore.page_for_issuer(): returns (file ids, next
+        page key or None).
+        """
+        visible = access.readable_ids(user)
+        self._refresh()
+        low = (since,) if since else None
+        # "2025-01-31" must include everything uploaded that day.
+        high = (until + "\uffff",) if until else None
+        if after is not None and (high is None or tuple(after) < high):
+            high = tuple(after)
+
+        with self._lock:
+            # Each filter is a group of posting sets; a file passes a group
+            # if any set in it holds the file. Only the smallest group is
+            # iterated, the others are membership tests, so a common word
+            # like "report" never has its postings copied.
+            groups = [[visible]]
+            groups.extend(self._prefix_postings(word) for word in tokenize(text))
+            for postings, key in ((self._issuers, issuer), (self._custodians, custodian),
+                                  (self._mime_types, mime_type)):
+                if key:
+                    groups.append([_ids(postings, key)])
+            groups.sort(key=lambda group: sum(map(len, group)))
+            smallest, others = groups[0], groups[1:]
+            base = smallest[0] if len(smallest) == 1 else set().union(*smallest)
+
+            def matches(file_id):
+                return all(any(file_id in ids for ids in group) for group in others)
+
+            # Walking the time index costs about limit * N / |base| steps;
+            # picking the newest of the base set costs about |base|.
+            if len(base) ** 2 > (limit + 1) * len(self._by_time):
+                found = self._walk(base, matches, low, high, limit)
+            else:
+                keys = self._keys
+                found = heapq.nlargest(limit + 1, (
+                    keys[file_id] for file_id in base
+                    if file_id in keys
+                    and (low is None or keys[file_id] >= low)
+                    and (high is None or keys[file_id] < high)
+                    and matches(file_id)
+                ))
+
+        if len(found) > limit:
+            return [key[2] for key in found[:limit]], found[limit - 1]
+        return [key[2] for key in found], None
+
+    def _walk(self, base, matches, low, high, limit):
+        """Newest-first scan of the time index between ``low`` and ``high``."""
+        by_time = self._by_time
+        stop = bisect.bisect_left(by_time, low) if low else 0
+        position = bisect.bisect_left(by_time, high) if high else len(by_time)
+        found = []
+        while position > stop and len(found) <= limit:
+            position -= 1
+            key = by_time[position]
+            if key[2] in base and matches(key[2]):
+                found.append(key)
+        return found
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_search_index():
+    """Return the process-wide SearchIndex."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SearchIndex(get_store())
+    return _index
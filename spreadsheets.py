@@ -0,0 +1,30 @@
+import csv
+import io
+
+
+def file_kind(filename):
+    """Lower-cased extension: "csv", "xlsx" or "xls"."""
+    return filename.rsplit('.', 1)[-1].lower()
+
+
+def iter_sheets(fileobj, kind):
+    """Yield (sheet_name, rows) for a CSV or XLSX file, streaming rows.
+
+    ``rows`` is an iterator of lists of cell values. CSV files have a single
+    sheet named "". openpyxl is imported on first use so that workers which
+    never parse spreadsheets do not pay for it.
+    """
+    if kind == "csv":
+        text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", errors="replace", newline="")
+        yield "", csv.reader(text)
+    elif kind == "xlsx":
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(fileobj, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                yield sheet.title, (list(row) for row in sheet.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+    else:
+        raise ValueError(f"Cannot parse .{kind} files")
@@ -0,0 +1,97 @@
+import os
+import threading
+
+import config
+from jsonstore import read_json, update_json
+from models import CODECS
+
+
+class UserSnapshot:
+    """One parsed copy of users.json plus the lookups the blueprints need.
+
+    ``users`` maps username to a validated models.UserRecord.
+    """
+
+    def __init__(self, users, generation):
+        self.users = users
+        self.generation = generation
+        self.roles = {name: user.role for name, user in users.items()}
+        self.manages = {name: tuple(user.manages) for name, user in users.items()}
+        self._manages_sets = {name: frozenset(m) for name, m in self.manages.items()}
+
+    def get(self, username):
+        return self.users.get(username)
+
+    def role(self, username):
+        return self.roles.get(username)
+
+    def has_role(self, username, role):
+        return self.roles.get(username) == role
+
+    def manages_user(self, username, other):
+        """True if ``other`` is in ``username``'s 'manages' list."""
+        return other in self._manages_sets.get(username, ())
+
+
+class UserDirectory:
+    """Per-process cache of users.json.
+
+    The file is re-parsed only when its (mtime, size, inode) stamp changes,
+    which covers writes from other workers; writes made through update()
+    invalidate the cache immediately.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stamp = None
+        self._generation = 0
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def snapshot(self):
+        """Return the current snapshot, reloading it if the file changed."""
+        stamp = self._file_stamp()
+        snapshot = self._snapshot
+        if snapshot is not None and stamp == self._stamp:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or stamp != self._stamp:
+                self._generation += 1
+                self._snapshot = UserSnapshot(
+                    read_json(self.path, {}, CODECS["json"].users), self._generation
+                )
+                self._stamp = stamp
+            return self._snapshot
+
+    def update(self, mutate):
+        """Locked read-modify-write of users.json (see jsonstore.update_json)."""
+        try:
+            return update_json(self.path, mutate, default={})
+        finally:
+            with self._lock:
+                self._snapshot = None
+
+    @property
+    def generation(self):
+        return self.snapshot().generation
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def get_directory():
+    """Return the process-wide UserDirectory for config.USER_FILE."""
+    global _directory
+    if _directory is None:
+        with _directory_lock:
+            if _directory is None:
+                _directory = UserDirectory(config.USER_FILE)
+    return _directory
@@ -0,0 +1,28 @@
+import mimetypes
+from datetime import datetime
+
+ALLOWED_EXTENSIONS = {"csv", "xlsx", "xls"}
+
+
+def allowed_file(filename):
+    """Check if the file has an allowed extension."""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def get_mime_type(filename):
+    """Get the MIME type of a file."""
+    mime_type, _ = mimetypes.guess_type(filename)
+    return mime_type or "application/octet-stream"
+
+
+def build_file_metadata(filename, size, issuer, custodians, sha256):
+    """Build the metadata record stored for an uploaded file."""
+    return {
+        "filename": filename,
+        "size": size,
+        "upload_time": datetime.utcnow().isoformat(),
+        "mime_type": get_mime_type(filename),
+        "issuer": issuer,
+        "custodians": custodians,
+        "sha256": sha256
+    }
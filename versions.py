@@ -0,0 +1,369 @@
+import difflib
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import Counter, deque
+from datetime import datetime
+from itertools import islice
+
+import blobstore
+import config
+from metadata_store import get_store
+from spreadsheets import file_kind
+
+# Row delta format: a header line, then operations applied to the previous
+# version's lines in order:
+#
+#   =<n>\n          copy the next n lines
+#   -<n>\n          skip the next n lines
+#   +<bytes>\n...   insert these bytes (whole lines)
+#
+# so a version is rebuilt in one pass over its base and its delta.
+DELTA_HEADER = b"rowdelta 1\n"
+# Inserted rows are written in runs of about this many bytes.
+INSERT_CHUNK = 1024 * 1024
+
+
+class VersionLog:
+    """History of files re-uploaded under the same name, in its own SQLite file.
+
+    A file gets rows here on its first re-upload: version 1 is its original
+    content and each later upload the next number. ``stored`` says how a
+    version's bytes are kept:
+
+      pending   its full blob, until the upload job has looked at it
+      snapshot  its full blob
+      delta     blob delta_sha256, a row delta against the previous version
+
+    The file's record always points at the latest version's blob, so
+    previews and ordinary downloads never replay deltas.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS versions (
+            file_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER,
+            upload_time TEXT NOT NULL,
+            stored TEXT NOT NULL,
+            delta_sha256 TEXT,
+            delta_size INTEGER,
+            PRIMARY KEY (file_id, version)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, record, sha256, size, upload_time):
+        """Append a pending version to the record's history and return its number."""
+        with self._connect() as conn:
+            if record.get("sha256"):
+                conn.execute(
+                    "INSERT OR IGNORE INTO versions (file_id, version, sha256, size, upload_time, stored)"
+                    " VALUES (?, 1, ?, ?, ?, 'snapshot')",
+                    (record["id"], record["sha256"], record.get("size"), record["upload_time"]),
+                )
+            # One statement, so concurrent uploads cannot take the same number.
+            conn.execute(
+                "INSERT INTO versions (file_id, version, sha256, size, upload_time, stored)"
+                " SELECT ?, COALESCE(MAX(version), 1) + 1, ?, ?, ?, 'pending' FROM versions WHERE file_id = ?",
+                (record["id"], sha256, size, upload_time, record["id"]),
+            )
+            return conn.execute(
+                "SELECT MAX(version) FROM versions WHERE file_id = ?", (record["id"],)
+            ).fetchone()[0]
+
+    def get(self, file_id, version):
+        row = self._connect().execute(
+            "SELECT * FROM versions WHERE file_id = ? AND version = ?", (file_id, version)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def current(self, file_id):
+        """The file's latest version, or None if it has no history."""
+        row = self._connect().execute(
+            "SELECT * FROM versions WHERE file_id = ? ORDER BY version DESC LIMIT 1", (file_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def history(self, file_id):
+        rows = self._connect().execute(
+            "SELECT * FROM versions WHERE file_id = ? ORDER BY version", (file_id,)
+        )
+        return [dict(row) for row in rows]
+
+    def latest(self, file_ids):
+        """Map of file id -> latest version number, for files that have a history."""
+        file_ids = list(file_ids)
+        if not file_ids:
+            return {}
+        placeholders = ", ".join("?" * len(file_ids))
+        rows = self._connect().execute(
+            "SELECT file_id, MAX(version) FROM versions WHERE file_id IN (" + placeholders + ")"
+            " GROUP BY file_id",
+            file_ids,
+        )
+        return dict(rows.fetchall())
+
+    def deltas_before(self, file_id, version):
+        """How many consecutive delta versions end at ``version``."""
+        rows = self._connect().execute(
+            "SELECT stored FROM versions WHERE file_id = ? AND version <= ? ORDER BY version DESC",
+            (file_id, version),
+        )
+        count = 0
+        for (stored,) in rows:
+            if stored != "delta":
+                break
+            count += 1
+        return count
+
+    def set_stored(self, file_id, version, stored, delta_sha256=None, delta_size=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE versions SET stored = ?, delta_sha256 = ?, delta_size = ?"
+                " WHERE file_id = ? AND version = ?",
+                (stored, delta_sha256, delta_size, file_id, version),
+            )
+
+    def referenced_blobs(self):
+        """Every blob some version is stored in, for blobstore.collect_garbage()."""
+        rows = self._connect().execute(
+            "SELECT CASE stored WHEN 'delta' THEN delta_sha256 ELSE sha256 END FROM versions"
+        )
+        return {sha256 for (sha256,) in rows}
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_versions():
+    """Return the process-wide VersionLog."""
+    global _log
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                _log = VersionLog(config.VERSIONS_DB_PATH)
+    return _log
+
+
+def add_version(record, sha256, size):
+    """Make a new upload the current content of an existing file record.
+
+    Returns the new version number, or None when the content is unchanged.
+    The caller then queues process_upload with the version, which decides
+    how the superseded content is kept.
+    """
+    if record.get("sha256") == sha256:
+        return None
+    version = get_versions().add(record, sha256, size, datetime.utcnow().isoformat())
+    get_store().set_blob(record["id"], sha256, size)
+    return version
+
+
+def _apply(base_lines, delta):
+    """Yield the lines of a version from its base's lines and an open delta."""
+    if delta.readline() != DELTA_HEADER:
+        raise ValueError("not a row delta")
+    for op in iter(delta.readline, b""):
+        code, count = op[:1], int(op[1:])
+        if code == b"+":
+            data = delta.read(count)
+            if len(data) != count:
+                raise ValueError("truncated row delta")
+            yield from io.BytesIO(data)
+            continue
+        seen = 0
+        for line in islice(base_lines, count):
+            seen += 1
+            if code == b"=":
+                yield line
+        if seen != count:
+            raise ValueError("row delta does not match its base")
+
+
+def _lines(log, file_id, version):
+    """Yield a version's lines, replaying deltas from the nearest full copy."""
+    entry = log.get(file_id, version)
+    if entry is None:
+        raise FileNotFoundError(f"file {file_id} has no version {version}")
+    if entry["stored"] != "delta" or blobstore.has_blob(entry["sha256"]):
+        with blobstore.open_blob(entry["sha256"]) as f:
+            yield from f
+        return
+    with blobstore.open_blob(entry["delta_sha256"]) as delta:
+        yield from _apply(_lines(log, file_id, version - 1), delta)
+
+
+def iter_version(file_id, version):
+    """Stream a version's bytes in blocks of about blobstore.READ_BLOCK_SIZE."""
+    block, size = [], 0
+    for line in _lines(get_versions(), file_id, version):
+        block.append(line)
+        size += len(line)
+        if size >= blobstore.READ_BLOCK_SIZE:
+            yield b"".join(block)
+            block, size = [], 0
+    if block:
+        yield b"".join(block)
+
+
+def _increasing(pairs):
+    """Longest subsequence of (i, j) pairs, sorted by i, whose j also increases."""
+    tail_js, tails, back = [], [], []
+    for k, (_, j) in enumerate(pairs):
+        # Rows mostly keep their order, so the append branch is the usual one.
+        pos = len(tail_js) if not tail_js or j > tail_js[-1] else bisect_left(tail_js, j)
+        if pos == len(tail_js):
+            tail_js.append(j)
+            tails.append(k)
+        else:
+            tail_js[pos] = j
+            tails[pos] = k
+        back.append(tails[pos - 1] if pos else None)
+    chain = []
+    k = tails[-1] if tails else None
+    while k is not None:
+        chain.append(pairs[k])
+        k = back[k]
+    return chain[::-1]
+
+
+def _add_opcode(opcodes, tag, i1, i2, j1, j2):
+    if tag == "equal" and opcodes and opcodes[-1][0] == "equal" and opcodes[-1][2] == i1:
+        opcodes[-1] = ("equal", opcodes[-1][1], i2, opcodes[-1][3], j2)
+    else:
+        opcodes.append((tag, i1, i2, j1, j2))
+
+
+def _diff(old, new):
+    """difflib-style opcodes turning the line hashes ``old`` into ``new``.
+
+    As in patience diff, lines that occur once in each version anchor the
+    match and SequenceMatcher only sees the gaps between anchors, so a few
+    changed rows in a large file cost little more than one pass.
+    """
+    old_counts, new_counts = Counter(old), Counter(new)
+    new_at = {line: j for j, line in enumerate(new)}
+    unique = [(i, new_at[line]) for i, line in enumerate(old) if old_counts[line] == 1 == new_counts.get(line)]
+
+    opcodes = []
+    i = j = 0
+    for anchor_i, anchor_j in _increasing(unique) + [(len(old), len(new))]:
+        if anchor_i > i or anchor_j > j:
+            gap = difflib.SequenceMatcher(None, old[i:anchor_i], new[j:anchor_j])
+            for tag, i1, i2, j1, j2 in gap.get_opcodes():
+                _add_opcode(opcodes, tag, i + i1, i + i2, j + j1, j + j2)
+        if anchor_i < len(old):
+            _add_opcode(opcodes, "equal", anchor_i, anchor_i + 1, anchor_j, anchor_j + 1)
+        i, j = anchor_i + 1, anchor_j + 1
+    return opcodes
+
+
+def _write_delta(opcodes, new_lines, write):
+    write(DELTA_HEADER)
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            write(b"=%d\n" % (i2 - i1))
+            deque(islice(new_lines, j2 - j1), maxlen=0)
+            continue
+        if i2 > i1:
+            write(b"-%d\n" % (i2 - i1))
+        run, size = [], 0
+        for line in islice(new_lines, j2 - j1):
+            run.append(line)
+            size += len(line)
+            if size >= INSERT_CHUNK:
+                write(b"+%d\n" % size + b"".join(run))
+                run, size = [], 0
+        if run:
+            write(b"+%d\n" % size + b"".join(run))
+
+
+def _build_delta(log, file_id, version, sha256):
+    """Write a row delta of ``version`` against the one before it.
+
+    Returns (delta sha256, size) with the delta in the blob store, or None
+    if replaying it would not reproduce ``sha256`` exactly.
+    """
+    old = [hash(line) for line in _lines(log, file_id, version - 1)]
+    with blobstore.open_blob(sha256) as f:
+        new = [hash(line) for line in f]
+    opcodes = _diff(old, new)
+
+    tmp_dir = os.path.join(config.BLOB_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        hasher = hashlib.sha256()
+        with os.fdopen(fd, "wb") as out, blobstore.open_blob(sha256) as f:
+            def write(data):
+                hasher.update(data)
+                out.write(data)
+            _write_delta(opcodes, iter(f), write)
+        # Line hashes can collide; only keep a delta that replays exactly.
+        check = hashlib.sha256()
+        with open(tmp_path, "rb") as delta:
+            for line in _apply(_lines(log, file_id, version - 1), delta):
+                check.update(line)
+        if check.hexdigest() != sha256:
+            os.unlink(tmp_path)
+            return None
+        size = os.path.getsize(tmp_path)
+        blobstore.adopt(tmp_path, hasher.hexdigest())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return hasher.hexdigest(), size
+
+
+def store_version(file_id, version, filename):
+    """Decide how a newly uploaded version is kept once it is superseded.
+
+    CSV versions become row deltas against the previous version unless a
+    snapshot is due or the delta would be too large; anything else stays a
+    full blob. Returns "delta" or "snapshot".
+    """
+    log = get_versions()
+    entry = log.get(file_id, version)
+    if entry is None or entry["stored"] != "pending":
+        return entry and entry["stored"]
+    base = log.get(file_id, version - 1)
+    if (
+        base is None
+        or file_kind(filename) != "csv"
+        or log.deltas_before(file_id, version - 1) + 1 >= config.VERSION_SNAPSHOT_EVERY
+    ):
+        log.set_stored(file_id, version, "snapshot")
+        return "snapshot"
+    delta = _build_delta(log, file_id, version, entry["sha256"])
+    if delta is None or delta[1] > config.VERSION_DELTA_MAX_RATIO * (entry["size"] or 0):
+        log.set_stored(file_id, version, "snapshot")
+        return "snapshot"
+    log.set_stored(file_id, version, "delta", *delta)
+    return "delta"
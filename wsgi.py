@@ -0,0 +1,9 @@
+"""WSGI entry point, e.g. ``gunicorn --preload -w 4 wsgi:app``.
+
+With PRELOAD=1 the caches are warmed here; under ``--preload`` that happens
+once in the master and the workers inherit them when they fork.
+"""
+import config
+from app import create_app
+
+app = create_app(preload=config.PRELOAD)